@@ -0,0 +1,67 @@
+import sys
+import json
+import argparse
+
+from pathlib import Path
+from typing import Any, Dict, Iterator, Tuple
+
+# Compares two runs of benchmarks.run, exits with 1 when a metric got worse
+# by more than the threshold, so it can gate CI.
+
+# Metric suffixes where a smaller value is better, and the ones where bigger is
+LOWER_IS_BETTER = ("_ms", "_mb", "_bytes", "seconds")
+HIGHER_IS_BETTER = ("_per_s",)
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Iterator[Tuple[str, float]]:
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+
+        if isinstance(value, dict):
+            yield from flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, float(value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    parser.add_argument("--all", action="store_true", help="also list unchanged metrics")
+    args = parser.parse_args()
+
+    baseline = dict(flatten(json.loads(args.baseline.read_text())["results"]))
+    current = dict(flatten(json.loads(args.current.read_text())["results"]))
+
+    regressions = 0
+
+    for name in sorted(baseline.keys() & current.keys()):
+        if name.endswith(LOWER_IS_BETTER):
+            sign = 1
+        elif name.endswith(HIGHER_IS_BETTER):
+            sign = -1
+        else:
+            continue
+
+        before, after = baseline[name], current[name]
+        change = (after - before) / before if before else 0.0
+
+        if sign * change > args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif sign * change < -args.threshold:
+            status = "improved"
+        elif args.all:
+            status = ""
+        else:
+            continue
+
+        print(f"{name:<60} {before:>14.3f} {after:>14.3f} {change:>+8.1%}  {status}")
+
+    print(f"{regressions} regressions above {args.threshold:.0%}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
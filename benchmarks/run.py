@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import asyncio
+import tempfile
+import argparse
+import platform
+import subprocess
+import statistics
+import multiprocessing
+
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.synthetic import generate_fleet, generate_gtfs, routes_ids
+
+# Benchmarks of the GTFS load, trip matching, feed building and HTTP serving
+# on a synthetic feed and fleet. Results are written as JSON, compare two runs with
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --output after.json
+#   python -m benchmarks.compare before.json after.json
+# Nothing here imports src at module level, gtfs_path has to be set first.
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    # samples in seconds, reported in milliseconds
+    ordered = sorted(samples)
+    at = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": at(0.50),
+        "p99_ms": at(0.99),
+        "max_ms": ordered[-1] * 1000
+    }
+
+
+def timed(function: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, AttributeError, ValueError):
+        pass
+
+    try:
+        import resource
+        # Peak instead of current outside Linux, kilobytes there too except on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        return None
+
+
+def service_time(args) -> datetime:
+    import pytz
+
+    timezone = pytz.timezone(os.environ["timezone"])
+    hour, minute = (int(part) for part in args.time.split(":"))
+
+    return timezone.localize(datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0))
+
+
+def load_fleet(args) -> List[Dict[str, Any]]:
+    # Loads the GTFS feed and the synthetic fleet into the contexts, returns the positions
+    from src.context import context, gtfs_context
+
+    gtfs_context.load()
+
+    devices, positions = generate_fleet(args.routes, args.stops, args.vehicles, service_time(args), args.seed)
+    context.routes_ids = routes_ids(args.routes)
+    context.load_data({"devices": devices})
+    context.load_data({"positions": positions})
+
+    # A tenth of the fleet left its route, so the alerts feed isn't empty
+    now = datetime.now().astimezone().isoformat(timespec="milliseconds")
+    context.load_data({"events": [
+        {"id": device["id"], "deviceId": device["id"], "type": "geofenceExited", "eventTime": now, "geofenceId": 0}
+        for device in devices[::10]
+    ]})
+
+    return positions
+
+
+# Run in fresh processes, so memory and import costs of one don't leak into the other
+
+def bench_load(clear_cache: bool) -> Dict[str, Any]:
+    import shutil
+
+    from src.context import GTFS_PATH, gtfs_context
+
+    if clear_cache:
+        shutil.rmtree(GTFS_PATH / ".cache", ignore_errors=True)
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    gtfs_context.load()
+    elapsed = time.perf_counter() - start
+
+    # Cached arrays are memory-mapped, touch the schedule like the first requests would
+    schedule = gtfs_context.schedule
+    touch_start = time.perf_counter()
+    for trip_id in schedule.trip_ids[::max(1, len(schedule.trip_ids) // 1000)].tolist():
+        gtfs_context.trip_arrays(trip_id)
+    touch = time.perf_counter() - touch_start
+
+    rss_after = rss_mb()
+
+    return {
+        "load_ms": elapsed * 1000,
+        "first_lookups_ms": touch * 1000,
+        "rss_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before if rss_after is not None and rss_before is not None else None
+    }
+
+
+def serve(args, port: int) -> None:
+    import logging
+    import uvicorn
+
+    logging.basicConfig(level=logging.WARNING)
+
+    load_fleet(args)
+
+    from src.api.views import app
+    from src.api.publisher import feed_publisher
+
+    # Feeds are built by the publisher, as in src.main
+    async def run() -> None:
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+        await asyncio.gather(server.serve(), feed_publisher.run())
+
+    asyncio.run(run())
+
+
+# Run in this process
+
+def bench_trip_mapper(args, positions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from src.translators.trip_mapper import TripMapper
+
+    routes = routes_ids(args.routes)
+    calls = [(routes[position["deviceId"] % args.routes], position["deviceTime"]) for position in positions]
+
+    cold = []
+    for route_id, device_time in calls:
+        TripMapper.clear_cache()
+        start = time.perf_counter()
+        TripMapper.map(route_id, device_time)
+        cold.append(time.perf_counter() - start)
+
+    for route_id, device_time in calls:
+        TripMapper.map(route_id, device_time)
+
+    warm = []
+    for route_id, device_time in calls:
+        start = time.perf_counter()
+        TripMapper.map(route_id, device_time)
+        warm.append(time.perf_counter() - start)
+
+    return {"cold": summarize(cold), "warm": summarize(warm)}
+
+
+def bench_feeds(args, positions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from google.protobuf.json_format import MessageToDict
+
+    from src.context import context
+    from src.api.snapshot import FeedSnapshot
+    from src.translators.trip_updates import TripUpdates
+    from src.translators.service_alerts import ServiceAlerts
+    from src.translators.vehicle_positions import VehiclePositions
+
+    rng = random.Random(args.seed)
+    moved = max(1, len(positions) // 10)
+
+    def move() -> None:
+        # A tenth of the fleet reports a new position, a second later
+        batch = []
+        for position in rng.sample(positions, moved):
+            fix_time = datetime.fromisoformat(position["fixTime"]) + timedelta(seconds=1)
+            position.update(fixTime=fix_time.isoformat(timespec="milliseconds"), deviceTime=fix_time.isoformat(timespec="milliseconds"))
+            batch.append(position)
+
+        context.load_data({"positions": batch})
+
+    results: Dict[str, Any] = {}
+
+    for name, translator in (("vehicle_positions", VehiclePositions), ("trip_updates", TripUpdates)):
+        def full() -> None:
+            context.mark_all_dirty()
+            translator.refresh()
+
+        def incremental() -> None:
+            move()
+            translator.refresh()
+
+        results[name] = {
+            "build_full": timed(full, args.repeat),
+            "build_incremental": timed(incremental, args.repeat)
+        }
+
+    results["service_alerts"] = {"build_full": timed(ServiceAlerts.make, args.repeat)}
+
+    feeds = {
+        "vehicle_positions": VehiclePositions.refresh(),
+        "trip_updates": TripUpdates.refresh(),
+        "service_alerts": ServiceAlerts.make()
+    }
+
+    for name, feed in feeds.items():
+        content = feed.SerializeToString()
+
+        results[name].update({
+            "entities": len(feed.entity),
+            "protobuf_bytes": len(content),
+            "gzip_bytes": len(gzip.compress(content, compresslevel=6, mtime=0)),
+            "serialize": timed(feed.SerializeToString, args.repeat),
+            "snapshot": timed(lambda: FeedSnapshot(feed), args.repeat),
+            "json": timed(lambda: json.dumps(MessageToDict(feed)), args.repeat)
+        })
+
+    return results
+
+
+async def poll(url: str, clients: int, duration: float) -> Dict[str, Any]:
+    import httpx
+
+    samples: List[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(http: "httpx.AsyncClient") -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await http.get(url, headers={"Accept-Encoding": "gzip"})
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            samples.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    return {**summarize(samples or [0.0]), "errors": errors, "requests_per_s": len(samples) / elapsed}
+
+
+def bench_http(args) -> Dict[str, Any]:
+    import httpx
+
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=serve, args=(args, args.port), daemon=True)
+    server.start()
+
+    base = f"http://127.0.0.1:{args.port}"
+
+    try:
+        deadline = time.monotonic() + 300
+        while True:
+            try:
+                # Up once the first feeds are published
+                httpx.get(base + "/gtfs-rt/trip-updates", timeout=1).raise_for_status()
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline or not server.is_alive():
+                    raise RuntimeError("The benchmark server didn't start")
+                time.sleep(0.2)
+
+        return {
+            path.strip("/").replace("/", "_").replace("-", "_"): asyncio.run(poll(base + path, args.clients, args.duration))
+            for path in ("/gtfs-rt/vehicle-positions", "/gtfs-rt/trip-updates", "/vehicle-positions")
+        }
+    finally:
+        server.terminate()
+        server.join()
+
+
+def bench_haversine(args) -> Dict[str, Any]:
+    # The trip update ETAs use haversine, check how far it is from the geodesic distance
+    from geopy.distance import geodesic
+    from src.factories.trip_update import TripUpdate
+
+    rng = random.Random(args.seed)
+    errors = []
+
+    for _ in range(2000):
+        lat1, lon1 = -2.9 + rng.uniform(-0.1, 0.1), -79.0 + rng.uniform(-0.1, 0.1)
+        lat2, lon2 = lat1 + rng.uniform(-0.1, 0.1), lon1 + rng.uniform(-0.1, 0.1)
+
+        reference = geodesic((lat1, lon1), (lat2, lon2)).km
+        if reference > 0.01:
+            errors.append(abs(float(TripUpdate.haversine_km(lat1, lon1, lat2, lon2)) - reference) / reference)
+
+    return {"pairs": len(errors), "mean_error_pct": statistics.fmean(errors) * 100, "max_error_pct": max(errors) * 100}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthetic scale benchmarks of traccar-to-gtfs-rt")
+    parser.add_argument("--routes", type=int, default=50)
+    parser.add_argument("--trips", type=int, default=170, help="trips per route, direction and service")
+    parser.add_argument("--stops", type=int, default=30, help="stops per trip")
+    parser.add_argument("--vehicles", type=int, default=500)
+    parser.add_argument("--time", default="10:00", help="local time of the fleet positions")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every build and serialization")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent HTTP clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of polling per endpoint")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--gtfs", type=Path, help="directory of the synthetic feed, reused when it exists")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--output", type=Path, help="JSON results, printed when missing")
+    args = parser.parse_args()
+
+    gtfs = args.gtfs or Path(tempfile.gettempdir()) / f"gtfs-bench-{args.routes}-{args.trips}-{args.stops}-{args.seed}"
+    os.environ["gtfs_path"] = str(gtfs)
+    os.environ.setdefault("timezone", "America/Guayaquil")
+
+    results: Dict[str, Any] = {}
+
+    if not (gtfs / "stop_times.txt").exists():
+        start = time.perf_counter()
+        counts = generate_gtfs(gtfs, args.routes, args.trips, args.stops, args.seed)
+        results["generate"] = {**counts, "seconds": time.perf_counter() - start}
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results["gtfs_load_csv"] = pool.submit(bench_load, True).result()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results["gtfs_load_cached"] = pool.submit(bench_load, False).result()
+
+    positions = load_fleet(args)
+
+    results["trip_mapper"] = bench_trip_mapper(args, positions)
+    results["feeds"] = bench_feeds(args, positions)
+    results["haversine"] = bench_haversine(args)
+
+    if not args.skip_http:
+        results["http"] = bench_http(args)
+
+    report = {
+        "meta": {
+            "time": datetime.now().astimezone().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "params": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "results": results
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import csv
+import math
+import random
+
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+# Synthetic GTFS feed and fleet at a configurable scale. stop_times.txt has
+# routes * 2 directions * 2 services * trips * stops rows, the defaults of
+# run.py give about 1M.
+
+# Feed center, the service area of the real feed
+CENTER = (-2.9, -79.0)
+# Meters between shape points, stops are every STOP_EVERY points
+POINT_SPACING_M = 50
+STOP_EVERY = 8
+SERVICES = {
+    "WK": (1, 1, 1, 1, 1, 0, 0),
+    "WE": (0, 0, 0, 0, 0, 1, 1),
+}
+
+def route_id(route: int) -> str:
+    return str(1000 + route)
+
+
+def generate_gtfs(directory: Path, routes: int, trips: int, stops: int, seed: int = 1) -> Dict[str, int]:
+    # trips per direction and service, stops per trip
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    counts = {"routes": routes, "trips": 0, "stops": 0, "stop_times": 0, "shape_points": 0}
+
+    with open(directory / "trips.txt", "w", newline="") as trips_file, \
+         open(directory / "stops.txt", "w", newline="") as stops_file, \
+         open(directory / "stop_times.txt", "w", newline="") as stop_times_file, \
+         open(directory / "shapes.txt", "w", newline="") as shapes_file:
+
+        trips_csv = csv.writer(trips_file)
+        stops_csv = csv.writer(stops_file)
+        stop_times_csv = csv.writer(stop_times_file)
+        shapes_csv = csv.writer(shapes_file)
+
+        trips_csv.writerow(["route_id", "service_id", "trip_id", "trip_headsign", "direction_id", "shape_id"])
+        stops_csv.writerow(["stop_id", "stop_name", "stop_lat", "stop_lon"])
+        stop_times_csv.writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"])
+        shapes_csv.writerow(["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"])
+
+        for route in range(routes):
+            points = _route_points(rng, stops * STOP_EVERY)
+
+            for direction in (0, 1):
+                shape_id = f"{route_id(route)}_{direction}"
+                shape = points if direction == 0 else points[::-1]
+
+                shapes_csv.writerows((shape_id, f"{lat:.6f}", f"{lon:.6f}", i + 1) for i, (lat, lon) in enumerate(shape))
+                counts["shape_points"] += len(shape)
+
+                stop_ids = []
+                for k in range(stops):
+                    lat, lon = shape[k * STOP_EVERY]
+                    stop_id = f"{shape_id}_{k}"
+                    stops_csv.writerow((stop_id, f"Stop {stop_id}", f"{lat + 0.00003:.6f}", f"{lon:.6f}"))
+                    stop_ids.append(stop_id)
+
+                counts["stops"] += stops
+
+                # Departures spread over 05:00 - 23:00, the last ones run past midnight
+                headway = 18 * 3600 // max(trips, 1)
+                for service in SERVICES:
+                    for trip in range(trips):
+                        trip_id = f"{shape_id}_{service}_{trip}"
+                        trips_csv.writerow((route_id(route), service, trip_id, f"Headsign {shape_id}", direction, shape_id))
+
+                        start = 5 * 3600 + trip * headway + direction * 300
+                        for sequence, stop_id in enumerate(stop_ids, start=1):
+                            time = _format_time(start + (sequence - 1) * 90)
+                            stop_times_csv.writerow((trip_id, time, time, stop_id, sequence))
+
+                        counts["trips"] += 1
+                        counts["stop_times"] += len(stop_ids)
+
+    with open(directory / "calendar.txt", "w", newline="") as f:
+        calendar_csv = csv.writer(f)
+        calendar_csv.writerow(["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"])
+        calendar_csv.writerows((service, *days, "20200101", "20991231") for service, days in SERVICES.items())
+
+    return counts
+
+
+def generate_fleet(routes: int, stops: int, vehicles: int, service_time: datetime, seed: int = 1) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    # Traccar devices and positions along the outbound shapes of generate_gtfs() with the same arguments
+    shape_rng = random.Random(seed)
+    shapes = [_route_points(shape_rng, stops * STOP_EVERY) for _ in range(routes)]
+
+    rng = random.Random(seed)
+    devices = []
+    positions = []
+
+    for device_id in range(1, vehicles + 1):
+        route = device_id % routes
+        devices.append({
+            "id": device_id,
+            "name": f"BUS{device_id:05d}",
+            # Geofence ids are the route numbers, see routes_ids()
+            "attributes": {"currentGeofence": route}
+        })
+
+        lat, lon = rng.choice(shapes[route])
+        positions.append({
+            "id": device_id,
+            "deviceId": device_id,
+            "latitude": lat,
+            "longitude": lon,
+            "course": 90.0,
+            "speed": rng.uniform(0, 12),
+            "deviceTime": service_time.isoformat(timespec="milliseconds"),
+            "fixTime": service_time.isoformat(timespec="milliseconds")
+        })
+
+    return devices, positions
+
+
+def routes_ids(routes: int) -> Dict[int, str]:
+    # DataContext geofence -> route mapping of the synthetic fleet
+    return {route: route_id(route) for route in range(routes)}
+
+
+def _route_points(rng: random.Random, count: int) -> List[Tuple[float, float]]:
+    # A gently curving line through a random point of a 20 km wide area
+    lat0 = CENTER[0] + rng.uniform(-0.09, 0.09)
+    lon0 = CENTER[1] + rng.uniform(-0.09, 0.09)
+    angle = rng.uniform(0, math.pi)
+
+    step = POINT_SPACING_M / 111195
+    return [
+        (lat0 + i * step * math.cos(angle) + 0.001 * math.sin(i / 15), lon0 + i * step * math.sin(angle))
+        for i in range(count)
+    ]
+
+
+def _format_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
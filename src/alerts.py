@@ -0,0 +1,124 @@
+import os
+import threading
+
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.state import VehicleEvent, parse_time
+
+def is_geofence_exit(event: VehicleEvent) -> bool:
+    return event.type == "geofenceExited" or (event.type == "alarm" and event.alarm == "geofenceExited")
+
+
+def is_geofence_enter(event: VehicleEvent) -> bool:
+    return event.type == "geofenceEntered" or (event.type == "alarm" and event.alarm == "geofenceEntered")
+
+
+class Alert:
+    # A vehicle out of its route's geofence, open until it's back or the TTL passes
+    __slots__ = ("id", "device_id", "route_id", "vehicle_name", "start", "end")
+
+    def __init__(self, alert_id: str, device_id, route_id, vehicle_name: str, start: float) -> None:
+        self.id = alert_id
+        self.device_id = device_id
+        self.route_id = route_id
+        self.vehicle_name = vehicle_name
+        # UNIX times of the active period, end is None while open
+        self.start = start
+        self.end: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.end is None
+
+
+class AlertStore:
+    # Seconds a closed alert is still published, so consumers see its end
+    CLOSED_RETENTION = 600
+
+    def __init__(self, ttl: Optional[float] = None) -> None:
+        # Seconds an alert stays open without the vehicle re-entering, read when the store is
+        # made so it doesn't depend on which module imported this one first
+        self.ttl = ttl if ttl is not None else float(os.getenv("alert_ttl") or 3600)
+        # (device_id, route_id) -> alert, one per vehicle and route
+        self._alerts: Dict[Tuple[Any, Any], Alert] = {}
+        # route_id -> alerts informing that route
+        self._by_route: Dict[Any, Dict[Tuple[Any, Any], Alert]] = {}
+        # Bumped on every change, feeds are rebuilt only when it moves
+        self.version = 0
+        # Events arrive on the event loop, feeds are built in another thread
+        self._lock = threading.Lock()
+
+    def exited(self, event: VehicleEvent, device_id, route_id, vehicle_name: str) -> bool:
+        key = (device_id, route_id)
+
+        with self._lock:
+            alert = self._alerts.get(key)
+
+            # Repeated exits while the alert is open are the same detour
+            if alert is not None and alert.is_open:
+                return False
+
+            alert = Alert(f"D{event.id}", device_id, route_id, vehicle_name, parse_time(event.event_time) or time())
+            self._alerts[key] = alert
+            self._by_route.setdefault(route_id, {})[key] = alert
+            self.version += 1
+
+        return True
+
+    def entered(self, event: VehicleEvent, device_id, route_id=None) -> bool:
+        # Closes the open alerts of the vehicle, all of them when the event has no geofence
+        end = parse_time(event.event_time) or time()
+        closed = False
+
+        with self._lock:
+            for alert in self._alerts.values():
+                if alert.device_id == device_id and alert.is_open and (route_id is None or alert.route_id == route_id):
+                    self._close(alert, end)
+                    closed = True
+
+        return closed
+
+    def expire(self, now: float) -> bool:
+        # Closes alerts past their TTL and forgets the ones closed long enough ago
+        changed = False
+
+        with self._lock:
+            for key, alert in list(self._alerts.items()):
+                if alert.is_open and now - alert.start > self.ttl:
+                    self._close(alert, alert.start + self.ttl)
+                    changed = True
+                elif not alert.is_open and now - alert.end > self.CLOSED_RETENTION:
+                    self._remove(key, alert)
+                    changed = True
+
+        return changed
+
+    def alerts(self) -> List[Alert]:
+        with self._lock:
+            return list(self._alerts.values())
+
+    def for_route(self, route_id) -> List[Alert]:
+        with self._lock:
+            return list(self._by_route.get(route_id, {}).values())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._alerts.clear()
+            self._by_route.clear()
+            self.version += 1
+
+    def _close(self, alert: Alert, end: float) -> None:
+        alert.end = max(end, alert.start)
+        self.version += 1
+
+    def _remove(self, key, alert: Alert) -> None:
+        del self._alerts[key]
+
+        route_alerts = self._by_route.get(alert.route_id)
+        if route_alerts is not None:
+            route_alerts.pop(key, None)
+            if not route_alerts:
+                del self._by_route[alert.route_id]
+
+        self.version += 1
@@ -0,0 +1,34 @@
+import orjson
+
+from typing import Any, Callable, Dict, Optional, Tuple
+from google.protobuf.json_format import MessageToDict
+
+class FeedJsonEncoder:
+    # JSON of a feed as MessageToDict would give it, encoded with orjson. With the
+    # translator's entities, only the entities rebuilt since the last feed are converted.
+    def __init__(self, entities: Optional[Callable[[], Dict[Any, Any]]] = None) -> None:
+        self._entities = entities
+        # key -> (entity, its encoded JSON), as of the last feed
+        self._encoded: Dict[Any, Tuple[Any, bytes]] = {}
+
+    def encode(self, feed) -> bytes:
+        if self._entities is None:
+            parts = [orjson.dumps(MessageToDict(entity)) for entity in feed.entity]
+        else:
+            # Must be called right after the feed was built from these entities
+            encoded = {}
+            for key, entity in self._entities().items():
+                cached = self._encoded.get(key)
+                if cached is None or cached[0] is not entity:
+                    cached = (entity, orjson.dumps(MessageToDict(entity)))
+                encoded[key] = cached
+
+            self._encoded = encoded
+            parts = [part for _, part in encoded.values()]
+
+        content = b'{"header":' + orjson.dumps(MessageToDict(feed.header))
+        # MessageToDict leaves out empty repeated fields
+        if parts:
+            content += b',"entity":[' + b",".join(parts) + b"]"
+
+        return content + b"}"
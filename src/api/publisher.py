@@ -0,0 +1,122 @@
+import time
+import asyncio
+import logging
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from src.api.snapshot import FeedSnapshot
+from src.api.feed_json import FeedJsonEncoder
+from src.api.shared import SharedFeedWriter
+from src.context import context, gtfs_context
+from src.metrics import FEED_SERIALIZE_SECONDS
+from src.translators.trip_updates import TripUpdates
+from src.translators.service_alerts import ServiceAlerts
+from src.translators.vehicle_positions import VehiclePositions
+
+logger = logging.getLogger(__name__)
+
+class FeedPublisher:
+    # Minimum seconds between publications, changes arriving meanwhile are coalesced
+    PUBLISH_INTERVAL = 1.0
+    # Feeds are rebuilt at least this often without changes, trip update delays depend on the time
+    REFRESH_INTERVAL = 30.0
+
+    # Built by the builder thread, ServiceAlerts.make reuses its feed while the alerts are unchanged
+    FEEDS = {
+        "vehicle_positions": VehiclePositions.refresh,
+        "trip_updates": TripUpdates.refresh,
+        "service_alerts": ServiceAlerts.make
+    }
+
+    def __init__(self) -> None:
+        # Unchanged vehicles keep their encoded JSON between publications
+        self._json = {
+            "vehicle_positions": FeedJsonEncoder(VehiclePositions.entities),
+            "trip_updates": FeedJsonEncoder(TripUpdates.entities),
+            "service_alerts": FeedJsonEncoder(ServiceAlerts.entities)
+        }
+        self._writers: Dict[str, SharedFeedWriter] = {}
+        self._published: Dict[str, FeedSnapshot] = {}
+        self._changed: Optional[asyncio.Event] = None
+        # Called on the event loop after every publication, see add_listener
+        self._listeners: List[Callable[[], None]] = []
+        # A single builder thread: the translators' state is never built twice at once,
+        # and the event loop keeps serving requests and ingesting meanwhile
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feed-builder")
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+
+    def notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+
+    def snapshot(self, name: str) -> Optional[FeedSnapshot]:
+        # Last published snapshot of the feed, None until the first build
+        return self._published.get(name)
+
+    def publish(self) -> None:
+        for name, build in self.FEEDS.items():
+            try:
+                feed = build()
+            except Exception as e:
+                logger.error(f"Failed to build {name}: {e}")
+                continue
+
+            if feed is None:
+                continue
+
+            published = self._published.get(name)
+            if published is not None and published.feed is feed:
+                continue
+
+            start_time = time.perf_counter()
+            snapshot = FeedSnapshot(feed, self._json[name].encode(feed))
+            FEED_SERIALIZE_SECONDS.observe(time.perf_counter() - start_time, name)
+
+            writer = self._writers.get(name)
+            if writer is not None:
+                writer.publish(snapshot)
+
+            self._published[name] = snapshot
+
+    async def run(self, directory: Optional[Path] = None) -> None:
+        # Without a directory the feeds are only published to this process
+        if directory is not None:
+            self._writers = {name: SharedFeedWriter(directory / f"{name}.feed") for name in self.FEEDS}
+            logger.info(f"Publishing feeds to {directory}")
+
+        self._changed = asyncio.Event()
+
+        context.add_listener(self.notify)
+        gtfs_context.add_listener(self.notify)
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                self._changed.clear()
+
+                # Awaited before the next round, so builds never overlap
+                await loop.run_in_executor(self._executor, self.publish)
+
+                for listener in self._listeners:
+                    try:
+                        listener()
+                    except Exception as e:
+                        logger.error(f"Feed publication listener failed: {e}")
+
+                await asyncio.sleep(self.PUBLISH_INTERVAL)
+
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.REFRESH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for writer in self._writers.values():
+                writer.close()
+
+
+feed_publisher: FeedPublisher = FeedPublisher()
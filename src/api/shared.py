@@ -0,0 +1,186 @@
+import os
+import mmap
+import struct
+import logging
+import tempfile
+
+from pathlib import Path
+from typing import Optional
+
+from src.api.snapshot import FeedSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Header of a feed file: magic, sequence number and size of each of the two slots
+HEADER = struct.Struct("<8sQQ")
+# Header of a slot: protobuf length, gzip length, feed timestamp and digest
+RECORD = struct.Struct("<IIQ16s")
+
+MAGIC = b"GTFSRT01"
+# Written over the magic of a replaced file, readers map the new one
+MOVED = b"MOVED\x00\x00\x00"
+
+def shared_feeds_dir() -> Path:
+    # RAM backed where available, the files are rewritten every second
+    directory = os.getenv("shared_feeds_dir")
+    if directory:
+        return Path(directory)
+
+    shm = Path("/dev/shm")
+    return (shm if shm.is_dir() else Path(tempfile.gettempdir())) / "traccar-to-gtfs-rt"
+
+
+class SharedFeedWriter:
+    # Slots grow to fit the biggest feed, starting at 1 MiB
+    MIN_CAPACITY = 1 << 20
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._capacity = 0
+        self._sequence = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A fresh file, so workers stop serving what a previous producer left behind
+        self._create(self.MIN_CAPACITY)
+
+    def publish(self, snapshot: FeedSnapshot) -> int:
+        size = RECORD.size + len(snapshot.content) + len(snapshot.gzip_content)
+        if size > self._capacity:
+            self._create(max(self._capacity * 2, -(-size // self.MIN_CAPACITY) * self.MIN_CAPACITY))
+
+        # Double buffered: readers use the slot of the current sequence, the other one is written
+        sequence = self._sequence + 1
+        offset = HEADER.size + (sequence % 2) * self._capacity
+
+        RECORD.pack_into(
+            self._map, offset,
+            len(snapshot.content), len(snapshot.gzip_content),
+            snapshot.timestamp, bytes.fromhex(snapshot.digest)
+        )
+
+        offset += RECORD.size
+        self._map[offset:offset + len(snapshot.content)] = snapshot.content
+
+        offset += len(snapshot.content)
+        self._map[offset:offset + len(snapshot.gzip_content)] = snapshot.gzip_content
+
+        # Publishing is the single write of the new sequence number
+        HEADER.pack_into(self._map, 0, MAGIC, sequence, self._capacity)
+        self._sequence = sequence
+
+        return sequence
+
+    def _create(self, capacity: int) -> None:
+        staging = self._path.with_name(f".{self._path.name}.{os.getpid()}")
+
+        with open(staging, "wb") as f:
+            f.truncate(HEADER.size + 2 * capacity)
+            f.write(HEADER.pack(MAGIC, self._sequence, capacity))
+
+        new_file = open(staging, "r+b")
+        new_map = mmap.mmap(new_file.fileno(), 0)
+
+        # Readers holding the current slot keep a consistent copy while the data is carried over
+        if self._map is not None and self._sequence:
+            start = HEADER.size + (self._sequence % 2) * self._capacity
+            new_start = HEADER.size + (self._sequence % 2) * capacity
+            new_map[new_start:new_start + self._capacity] = self._map[start:start + self._capacity]
+
+        try:
+            previous = open(self._path, "r+b")
+        except FileNotFoundError:
+            previous = None
+
+        os.replace(staging, self._path)
+
+        # Also tells workers still mapping the file of a previous producer
+        if previous is not None:
+            with previous:
+                previous.write(MOVED)
+
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+
+            logger.info(f"Shared feed {self._path.name} grown to {capacity} bytes per slot")
+
+        self._file = new_file
+        self._map = new_map
+        self._capacity = capacity
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+
+class SharedFeedReader:
+    # Attempts to read a slot that keeps being overwritten before giving up for this request
+    MAX_RETRIES = 8
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._map: Optional[mmap.mmap] = None
+
+        self.sequence = 0
+        self._snapshot: Optional[FeedSnapshot] = None
+
+    def current(self) -> Optional[FeedSnapshot]:
+        for _ in range(self.MAX_RETRIES):
+            if self._map is None and not self._open():
+                return None
+
+            magic, sequence, capacity = HEADER.unpack_from(self._map, 0)
+
+            if magic != MAGIC:
+                # Replaced by a bigger file or a new producer
+                self._close()
+                continue
+
+            # Nothing published yet
+            if sequence == 0:
+                self.sequence, self._snapshot = 0, None
+                return None
+
+            # Nothing new, no copy and no work at all
+            if sequence == self.sequence:
+                return self._snapshot
+
+            offset = HEADER.size + (sequence % 2) * capacity
+            content_length, gzip_length, timestamp, digest = RECORD.unpack_from(self._map, offset)
+
+            offset += RECORD.size
+            content = self._map[offset:offset + content_length]
+            gzip_content = self._map[offset + content_length:offset + content_length + gzip_length]
+
+            # Any newer sequence means the writer may already be refilling this slot for the one
+            # after it, the header only moves once that write is done, so read again
+            if HEADER.unpack_from(self._map, 0)[1] != sequence:
+                continue
+
+            self.sequence = sequence
+            self._snapshot = FeedSnapshot.restore(content, gzip_content, digest.hex(), timestamp)
+
+            return self._snapshot
+
+        logger.warning(f"Shared feed {self._path.name} changed too fast to be read")
+        return self._snapshot
+
+    def _open(self) -> bool:
+        try:
+            with open(self._path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # The producer didn't create it yet
+            return False
+
+        return True
+
+    def _close(self) -> None:
+        self._map.close()
+        self._map = None
+        # Sequences of the new file can't be compared with the old one
+        self.sequence = 0
@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+
+from typing import Optional
+from email.utils import formatdate
+from fastapi import Request, Response
+
+class FeedSnapshot:
+    __slots__ = ("feed", "content", "gzip_content", "json_content", "etag", "gzip_etag", "timestamp", "last_modified")
+
+    def __init__(self, feed, json_content: Optional[bytes] = None) -> None:
+        # Everything a response needs is computed once per feed, not per request
+        self.feed = feed
+        self.content = feed.SerializeToString()
+        # Encoded JSON of the feed, when the publisher made it
+        self.json_content = json_content
+        self.gzip_content = gzip.compress(self.content, compresslevel=6, mtime=0)
+
+        self._set_digest(hashlib.blake2b(self.content, digest_size=16).hexdigest(), feed.header.timestamp)
+
+    @classmethod
+    def restore(cls, content: bytes, gzip_content: bytes, digest: str, timestamp: int) -> "FeedSnapshot":
+        # Snapshot published by another process, only the bytes are available
+        snapshot = cls.__new__(cls)
+        snapshot.feed = None
+        snapshot.content = content
+        snapshot.gzip_content = gzip_content
+        snapshot.json_content = None
+        snapshot._set_digest(digest, timestamp)
+
+        return snapshot
+
+    def _set_digest(self, digest: str, timestamp: int) -> None:
+        self.etag = f'"{digest}"'
+        # Each encoding is its own representation, so it gets its own strong ETag
+        self.gzip_etag = f'"{digest}-gzip"'
+        self.timestamp = timestamp
+
+        self.last_modified = formatdate(timestamp, usegmt=True)
+
+    @property
+    def digest(self) -> str:
+        return self.etag.strip('"')
+
+    def matches(self, if_none_match: str) -> bool:
+        if not if_none_match:
+            return False
+
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+        return "*" in tags or self.etag in tags or self.gzip_etag in tags
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+
+        if name.strip().lower() in ("gzip", "*"):
+            # "gzip;q=0" explicitly refuses it
+            quality = params.strip().removeprefix("q=")
+            try:
+                return not params or float(quality) > 0
+            except ValueError:
+                return True
+
+    return False
+
+
+def protobuf_response(request: Request, snapshot: FeedSnapshot) -> Response:
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+
+    headers = {
+        "ETag": snapshot.gzip_etag if use_gzip else snapshot.etag,
+        "Last-Modified": snapshot.last_modified,
+        "Vary": "Accept-Encoding"
+    }
+
+    if snapshot.matches(request.headers.get("if-none-match", "")):
+        return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(
+        content=snapshot.gzip_content if use_gzip else snapshot.content,
+        media_type="application/x-protobuf",
+        status_code=200,
+        headers=headers
+    )
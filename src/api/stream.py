@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from time import monotonic
+from typing import Any, Dict, Set
+from google.transit import gtfs_realtime_pb2 as gtfsrt
+
+from src.api.publisher import feed_publisher
+from src.factories.feed_message import FeedMessage
+from src.translators.trip_updates import TripUpdates
+from src.translators.vehicle_positions import VehiclePositions
+
+logger = logging.getLogger(__name__)
+
+class Subscriber:
+    def __init__(self, max_pending: int) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+
+    def offer(self, message: bytes, snapshot) -> None:
+        if not self.queue.full():
+            self.queue.put_nowait(message)
+            return
+
+        # Too slow to keep up: its pending diffs are useless, resync it with a full feed
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        self.queue.put_nowait(snapshot())
+
+
+class FeedStream:
+    # Messages waiting for a subscriber before it's considered lagging
+    MAX_PENDING = 16
+
+    def __init__(self, name: str, translator) -> None:
+        self._name = name
+        self._translator = translator
+        self._subscribers: Set[Subscriber] = set()
+        # entity id -> entity as of the last push
+        self._sent: Dict[Any, Any] = {}
+
+    def subscribe(self) -> Subscriber:
+        # The last published feed is what the next diff is computed against
+        subscriber = Subscriber(self.MAX_PENDING)
+
+        snapshot = feed_publisher.snapshot(self._name)
+        if snapshot is not None:
+            subscriber.queue.put_nowait(snapshot.content)
+
+        self._subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self._subscribers.discard(subscriber)
+
+    def push(self, full: bool = False) -> None:
+        # Called right after a publication, the builder thread is idle until it returns
+        snapshot = feed_publisher.snapshot(self._name)
+        if snapshot is None:
+            return
+
+        current = self._translator.entities()
+
+        # Rebuilt entities are new objects, unchanged ones are the same instance
+        changed = [entity for key, entity in current.items() if self._sent.get(key) is not entity]
+        deleted = [gtfsrt.FeedEntity(id=entity.id, is_deleted=True) for key, entity in self._sent.items() if key not in current]
+
+        self._sent = dict(current)
+
+        if not self._subscribers:
+            return
+
+        if full:
+            message = snapshot.content
+        elif changed or deleted:
+            message = FeedMessage.create(entities=changed + deleted, incrementality="DIFFERENTIAL").SerializeToString()
+        else:
+            return
+
+        for subscriber in list(self._subscribers):
+            subscriber.offer(message, lambda: snapshot.content)
+
+
+class FeedStreams:
+    # Seconds between full snapshots, so subscribers can resync
+    SNAPSHOT_INTERVAL = 60.0
+
+    def __init__(self) -> None:
+        self.vehicle_positions = FeedStream("vehicle_positions", VehiclePositions)
+        self.trip_updates = FeedStream("trip_updates", TripUpdates)
+        self._last_snapshot = monotonic()
+
+        # Pushed with every publication, so streams and snapshots never disagree
+        feed_publisher.add_listener(self.push)
+
+    def push(self) -> None:
+        full = monotonic() >= self._last_snapshot + self.SNAPSHOT_INTERVAL
+        if full:
+            self._last_snapshot = monotonic()
+
+        for stream in (self.vehicle_positions, self.trip_updates):
+            try:
+                stream.push(full)
+            except Exception as e:
+                logger.error(f"Failed to push feed stream: {e}")
+
+
+feed_streams: FeedStreams = FeedStreams()
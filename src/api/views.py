@@ -1,78 +1,174 @@
-from fastapi import FastAPI, Response
-from google.protobuf.json_format import MessageToDict
+import os
+import hmac
+import time
+from typing import Optional
 
-from src.translators.trip_updates import TripUpdates
-from src.translators.service_alerts import ServiceAlerts
-from src.translators.vehicle_positions import VehiclePositions
+from fastapi import FastAPI, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
+
+from src.api.publisher import feed_publisher
+from src.api.snapshot import protobuf_response
+from src.api.stream import FeedStream, feed_streams
+from src.context import context, gtfs_context
+from src.metrics import FEED_TIMESTAMP, TRACCAR_CONNECTED, TRACCAR_LAST_MESSAGE, registry
+from src.translators.trip_mapper import TripMapper
+from src.websocket.ingest import ingest
 
 app = FastAPI(title="Traccar to GTFS-RT")
 
+# Feeds are built by feed_publisher in the background, handlers only serve its last snapshot
+
+def _protobuf(request: Request, name: str, missing: str) -> Response:
+    snapshot = feed_publisher.snapshot(name)
+
+    if snapshot is None:
+        return Response(content=missing, media_type="text/plain", status_code=404)
+
+    return protobuf_response(request, snapshot)
+
+def _json(name: str, missing: str) -> Response:
+    snapshot = feed_publisher.snapshot(name)
+
+    if snapshot is None:
+        return JSONResponse(content={"error": missing})
+
+    # Encoded by the publisher, the same as MessageToDict of the feed
+    return Response(content=snapshot.json_content, media_type="application/json")
+
+async def _stream(websocket: WebSocket, stream: FeedStream) -> None:
+    await websocket.accept()
+    subscriber = stream.subscribe()
+
+    try:
+        while True:
+            await websocket.send_bytes(await subscriber.queue.get())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        stream.unsubscribe(subscriber)
+
 @app.get('/')
 async def root():
     return {"message": "Traccar to GTFS-RT is running!"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def get_health():
+    # 503 takes the instance out of the load balancer
+    max_age = float(os.getenv("health_max_age") or 300)
+    now = time.time()
+    problems = []
+
+    connected = bool(TRACCAR_CONNECTED.value())
+    if not connected:
+        problems.append("Traccar WebSocket disconnected")
+
+    last_message = TRACCAR_LAST_MESSAGE.value()
+    if last_message is None or now - last_message > max_age:
+        problems.append(f"No Traccar message in the last {max_age:.0f}s")
+
+    # Newest fix of the fleet, the feeds can't be fresher than this
+    fixes = [state.fix_time for state in context.data.values() if state.fix_time is not None]
+    last_fix = max(fixes) if fixes else None
+    if last_fix is None or now - last_fix > max_age:
+        problems.append(f"No position fixed in the last {max_age:.0f}s")
+
+    feeds = {}
+    for name in ("vehicle_positions", "trip_updates", "service_alerts"):
+        timestamp = FEED_TIMESTAMP.value(name)
+        feeds[name] = {"age": round(now - timestamp, 1) if timestamp else None}
+
+    health = {
+        "status": "degraded" if problems else "ok",
+        "problems": problems,
+        "traccar": {
+            "connected": connected,
+            "last_message_age": round(now - last_message, 1) if last_message else None
+        },
+        "last_fix_age": round(now - last_fix, 1) if last_fix else None,
+        "feeds": feeds
+    }
+
+    return JSONResponse(content=health, status_code=503 if problems else 200)
+
+@app.get("/ingest/stats")
+async def get_ingest_stats():
+    # Queue depth and coalescing counters of the Traccar ingest pipeline
+    return ingest.stats()
+
+@app.get("/trip-mapper/stats")
+async def get_trip_mapper_stats():
+    # Trip mapping cache usage and the number of vehicles with an assigned trip
+    return TripMapper.stats()
+
 @app.get("/gtfs-rt/vehicle-positions", response_class=Response)
-async def get_vehicle_positions_pb():
-    feed = VehiclePositions.make()
-
-    if feed is None:
-        return Response(content="No vehicle positions available!", media_type="text/plain", status_code=404)
-    
-    return Response(
-        content=feed.SerializeToString(),
-        media_type="application/x-protobuf",
-        status_code=200
-    )
+async def get_vehicle_positions_pb(request: Request):
+    return _protobuf(request, "vehicle_positions", "No vehicle positions available!")
+
+@app.websocket("/gtfs-rt/vehicle-positions/stream")
+async def stream_vehicle_positions(websocket: WebSocket):
+    # Full feed first, then DIFFERENTIAL feeds with the changed and deleted vehicles
+    await _stream(websocket, feed_streams.vehicle_positions)
 
 @app.get("/vehicle-positions")
 async def get_vehicle_positions_json():
-    feed = VehiclePositions.make()
-
-    if feed is None:
-        return {"error": "No vehicle positions available!"}
-    
-    return MessageToDict(feed)
+    return _json("vehicle_positions", "No vehicle positions available!")
 
 @app.get("/gtfs-rt/trip-updates", response_class=Response)
-async def get_trip_updates_pb():
-    feed = TripUpdates.make()
-
-    if feed is None:
-        return Response(content="No trip updates available!", media_type="text/plain", status_code=404)
-    
-    return Response(
-        content=feed.SerializeToString(),
-        media_type="application/x-protobuf",
-        status_code=200
-    )
+async def get_trip_updates_pb(request: Request):
+    return _protobuf(request, "trip_updates", "No trip updates available!")
+
+@app.websocket("/gtfs-rt/trip-updates/stream")
+async def stream_trip_updates(websocket: WebSocket):
+    await _stream(websocket, feed_streams.trip_updates)
 
 @app.get("/trip-updates")
 async def get_trip_updates_json():
-    feed = TripUpdates.make()
-
-    if feed is None:
-        return {"error": "No trip updates available!"}
-    
-    return MessageToDict(feed)
+    return _json("trip_updates", "No trip updates available!")
 
 @app.get("/gtfs-rt/service-alerts", response_class=Response)
-async def get_service_alerts_pb():
-    feed = ServiceAlerts.make()
-
-    if feed is None:
-        return Response(content="No service alerts available!", media_type="text/plain", status_code=404)
-    
-    return Response(
-        content=feed.SerializeToString(),
-        media_type="application/x-protobuf",
-        status_code=200
-    )
+async def get_service_alerts_pb(request: Request):
+    return _protobuf(request, "service_alerts", "No service alerts available!")
 
 @app.get("/service-alerts")
 async def get_service_alerts_json():
-    feed = ServiceAlerts.make()
+    return _json("service_alerts", "No service alerts available!")
+
+def _check_admin_token(x_admin_token: Optional[str]) -> Optional[Response]:
+    # The admin endpoints are disabled until a token is configured
+    admin_token = os.getenv("admin_token")
+
+    if not admin_token:
+        return Response(content="Not Found", media_type="text/plain", status_code=404)
+
+    if not hmac.compare_digest(x_admin_token or "", admin_token):
+        return Response(content="Invalid admin token!", media_type="text/plain", status_code=403)
+
+    return None
+
+@app.post("/admin/reload-gtfs")
+async def reload_gtfs(x_admin_token: Optional[str] = Header(None)):
+    denied = _check_admin_token(x_admin_token)
+    if denied is not None:
+        return denied
+
+    try:
+        reloaded = await gtfs_context.reload()
+    except Exception as e:
+        return Response(content=f"GTFS reload failed: {e}", media_type="text/plain", status_code=500)
+
+    if not reloaded:
+        return Response(content="A GTFS reload is already running, it will load the files again when done!", media_type="text/plain", status_code=202)
+
+    return {"message": "GTFS data reloaded!"}
+
+@app.post("/admin/reload-routes")
+async def reload_routes(x_admin_token: Optional[str] = Header(None)):
+    denied = _check_admin_token(x_admin_token)
+    if denied is not None:
+        return denied
 
-    if feed is None:
-        return {"error": "No service alerts available!"}
-    
-    return MessageToDict(feed)
\ No newline at end of file
+    return {"message": "Geofence routes reloaded!", "geofences": context.reload_routes()}
@@ -0,0 +1,98 @@
+import os
+import time
+import orjson
+
+from typing import Dict, Tuple
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from google.protobuf.json_format import MessageToDict
+from google.transit import gtfs_realtime_pb2 as gtfsrt
+
+from src.api.snapshot import protobuf_response
+from src.api.shared import SharedFeedReader, shared_feeds_dir
+
+# Served by the uvicorn workers in multi-worker mode. Feeds are only read from
+# the shared buffers of the producer process, nothing here touches Traccar or GTFS.
+app = FastAPI(title="Traccar to GTFS-RT")
+
+_directory = shared_feeds_dir()
+_readers: Dict[str, SharedFeedReader] = {
+    name: SharedFeedReader(_directory / f"{name}.feed")
+    for name in ("vehicle_positions", "trip_updates", "service_alerts")
+}
+# name -> (sequence, encoded JSON of the feed), decoded once per published feed
+_json: Dict[str, Tuple[int, bytes]] = {}
+
+def _protobuf(request: Request, name: str, missing: str) -> Response:
+    snapshot = _readers[name].current()
+
+    if snapshot is None:
+        return Response(content=missing, media_type="text/plain", status_code=404)
+
+    return protobuf_response(request, snapshot)
+
+def _dict(name: str, missing: str) -> Response:
+    reader = _readers[name]
+    snapshot = reader.current()
+
+    if snapshot is None:
+        return JSONResponse(content={"error": missing})
+
+    # Only the protobuf is shared, every worker encodes the JSON once per feed
+    cached = _json.get(name)
+    if cached is None or cached[0] != reader.sequence:
+        cached = (reader.sequence, orjson.dumps(MessageToDict(gtfsrt.FeedMessage.FromString(snapshot.content))))
+        _json[name] = cached
+
+    return Response(content=cached[1], media_type="application/json")
+
+@app.get('/')
+async def root():
+    return {"message": "Traccar to GTFS-RT is running!"}
+
+@app.get("/health")
+async def get_health():
+    # Only the published feeds are visible here, a stalled producer or Traccar shows as a stale feed
+    max_age = float(os.getenv("health_max_age") or 300)
+    now = time.time()
+
+    feeds = {}
+    for name, reader in _readers.items():
+        snapshot = reader.current()
+        feeds[name] = {
+            "age": round(now - snapshot.timestamp, 1) if snapshot else None,
+            "sequence": reader.sequence
+        }
+
+    age = feeds["vehicle_positions"]["age"]
+    problems = [] if age is not None and age <= max_age else [f"No vehicle positions published in the last {max_age:.0f}s"]
+
+    return JSONResponse(
+        content={"status": "degraded" if problems else "ok", "problems": problems, "feeds": feeds},
+        status_code=503 if problems else 200
+    )
+
+@app.get("/gtfs-rt/vehicle-positions", response_class=Response)
+async def get_vehicle_positions_pb(request: Request):
+    return _protobuf(request, "vehicle_positions", "No vehicle positions available!")
+
+@app.get("/vehicle-positions")
+async def get_vehicle_positions_json():
+    return _dict("vehicle_positions", "No vehicle positions available!")
+
+@app.get("/gtfs-rt/trip-updates", response_class=Response)
+async def get_trip_updates_pb(request: Request):
+    return _protobuf(request, "trip_updates", "No trip updates available!")
+
+@app.get("/trip-updates")
+async def get_trip_updates_json():
+    return _dict("trip_updates", "No trip updates available!")
+
+@app.get("/gtfs-rt/service-alerts", response_class=Response)
+async def get_service_alerts_pb(request: Request):
+    return _protobuf(request, "service_alerts", "No service alerts available!")
+
+@app.get("/service-alerts")
+async def get_service_alerts_json():
+    return _dict("service_alerts", "No service alerts available!")
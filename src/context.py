@@ -1,16 +1,42 @@
-import re
-import json
+import os
+import pytz
+import asyncio
 import logging
+import threading
+import numpy as np
 import pandas as pd
 
-from datetime import datetime
+from time import time
+from datetime import date, datetime
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+from watchfiles import awatch
+from dotenv import load_dotenv
+
+# Settings are read when the modules are imported, so .env goes first, before any of them
+load_dotenv()
+
+from src.state import VehicleEvent, VehicleState
+from src.alerts import AlertStore, is_geofence_enter, is_geofence_exit
+from src.routes import DEFAULT_ROUTES, RouteInference, geofence_routes, load_routes
+from src.metrics import INGEST_ITEMS, INGEST_LAG
+from src.gtfs.cache import GtfsCache
+from src.gtfs.calendar import ServiceCalendar
+from src.gtfs.shapes import ShapeIndex
+from src.gtfs.schedule import Schedule, TripArrays
 
 logger = logging.getLogger(__name__)
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # Va al root del proyecto
-GTFS_PATH = BASE_DIR / "gtfs"
+# gtfs_path points somewhere else, like the synthetic feeds of the benchmarks
+GTFS_PATH = Path(os.getenv("gtfs_path") or BASE_DIR / "gtfs")
+# JSON file of geofence id -> route_id, overrides the route attribute of the Traccar geofences
+ROUTES_PATH = Path(os.getenv("routes_path") or BASE_DIR / "routes.json")
+GEOFENCE_ROUTE_ATTRIBUTE = os.getenv("geofence_route_attribute") or "route_id"
+# Guess the route of vehicles outside any mapped geofence from the shapes they drive along
+INFER_ROUTES = os.getenv("infer_routes", "").lower() in ("1", "true", "yes")
+# Resolved once, device times and the schedule's service days are in this zone
+TIMEZONE = pytz.timezone(os.getenv("timezone"))
 
 class SingletonMeta(type):
     _instaces = {}
@@ -25,44 +51,64 @@ class SingletonMeta(type):
 
 class DataContext(metaclass=SingletonMeta):
     def __init__(self):
-        self.data: Dict[str, Dict[str, Any]] = {}
-        self.routes_ids = {
-            1: "55",
-            2: "50",
-            3: "62",
-            4: "53",
-            5: "54",
-            6: "60",
-            7: "51",
-            8: "52",
-            9: "56",
-            10: "57",
-            11: "58",
-            12: "59",
-            59: "61",
-            60: "64",
-            61: "63",
-        }
+        self.data: Dict[Any, VehicleState] = {}
+        # Geofence -> route_id, from routes_path and the Traccar geofences, see reload_routes
+        self._configured_routes = load_routes(ROUTES_PATH)
+        self._traccar_routes: Dict[int, str] = {}
+        self.routes_ids = self._merge_routes()
+        self._inference = RouteInference() if INFER_ROUTES else None
+        # Geofence exit alerts, fed by the events as they arrive
+        self.alerts = AlertStore()
+        # Devices changed since each feed builder last asked, see take_dirty.
+        # Feeds are built in another thread, the lock keeps a set from changing while it's taken
+        self._dirty: Dict[str, Set[Any]] = {}
+        self._dirty_lock = threading.Lock()
+        self._changes = 0
+        # Called after a message changed some device, see add_listener
+        self._listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
 
     def load_data(self, message):
-        if "devices" in message:
+        changes = self._changes
+
+        if "geofences" in message:
+            self._traccar_routes = geofence_routes(message["geofences"], GEOFENCE_ROUTE_ATTRIBUTE)
+            self._set_routes()
+        elif "devices" in message:
+            INGEST_ITEMS.inc("devices", amount=len(message["devices"]))
+
             for device in message["devices"]:
-                device_attributes = device.get("attributes", {})
-                current_geofence = device_attributes.get("currentGeofence")
-                if current_geofence is not None:
-                    if current_geofence in self.routes_ids:
-                        device["route_id"] = self.routes_ids[current_geofence]
-                        self.data[device["id"]] = device
+                # Devices out of any mapped geofence are kept, without a route they're left out of the feeds
+                self._update_device(device, device.get("attributes", {}).get("currentGeofence"))
         elif "events" in message:
+            INGEST_ITEMS.inc("events", amount=len(message["events"]))
+
             for event in message["events"]:
-                device_id = event["deviceId"]
-                if device_id in self.data:
-                    self.data[device_id]["event"] = event
+                state = self.data.get(event["deviceId"])
+                if state is not None:
+                    self._apply_event(state, VehicleEvent(event))
         elif "positions" in message:
+            INGEST_ITEMS.inc("positions", amount=len(message["positions"]))
+            now = time()
+
             for position in message["positions"]:
                 device_id = position["deviceId"]
-                if device_id in self.data: 
-                    self.data[device_id]["position"] = position
+                state = self.data.get(device_id)
+                if state is not None and state.update_position(position):
+                    self._mark_dirty(device_id)
+
+                    if state.fix_time is not None:
+                        INGEST_LAG.observe(now - state.fix_time)
+
+                    if self._inference is not None and state.geofence_id not in self.routes_ids:
+                        self._inference.observe(device_id, gtfs_context.routes_near(state.latitude, state.longitude))
+                        self._assign_route(state)
+
+        if self._changes != changes:
+            for listener in self._listeners:
+                listener()
 
         # self.test_events()
         
@@ -70,11 +116,118 @@ class DataContext(metaclass=SingletonMeta):
         # with open("data.json", "w") as f:
         #     json.dump(self.data, f, indent=4)
 
+    def _apply_event(self, state: VehicleState, event: VehicleEvent) -> None:
+        state.event = event
+        self._mark_dirty(state.id)
+
+        if not is_geofence_exit(event) and not is_geofence_enter(event):
+            return
+
+        if not event.geofence_id:
+            # Without a geofence the exit is from the route the vehicle is on, an enter closes all
+            route_id = state.route_id
+            entered_route_id = None
+        elif event.geofence_id in self.routes_ids:
+            route_id = entered_route_id = self.routes_ids[event.geofence_id]
+        else:
+            # A geofence that isn't a route, like a depot or a terminal, is no detour
+            return
+
+        if is_geofence_exit(event) and route_id is not None:
+            self.alerts.exited(event, state.id, route_id, state.name)
+        elif is_geofence_enter(event):
+            self.alerts.entered(event, state.id, entered_route_id)
+
+    def _update_device(self, device: Dict[str, Any], geofence_id) -> None:
+        state = self.data.get(device["id"])
+
+        # Keep the last position and event of known devices
+        if state is None:
+            state = self.data[device["id"]] = VehicleState(device["id"], device.get("name"), None)
+        else:
+            state.name = device.get("name")
+
+        state.geofence_id = geofence_id
+        self._assign_route(state)
+
+        self._mark_dirty(device["id"])
+
+    def _assign_route(self, state: VehicleState) -> bool:
+        # The geofence's route, or the inferred one for vehicles outside the mapped geofences
+        route_id = self.routes_ids.get(state.geofence_id)
+
+        if route_id is None and self._inference is not None:
+            route_id = self._inference.route(state.id)
+        elif self._inference is not None:
+            self._inference.forget(state.id)
+
+        if route_id == state.route_id:
+            return False
+
+        state.route_id = route_id
+        self._mark_dirty(state.id)
+
+        return True
+
+    def _merge_routes(self) -> Dict[int, str]:
+        routes = {**self._traccar_routes, **(self._configured_routes or {})}
+        return routes or dict(DEFAULT_ROUTES)
+
+    def _set_routes(self) -> None:
+        self.routes_ids = self._merge_routes()
+
+        changed = [state.id for state in self.data.values() if self._assign_route(state)]
+        logger.info(f"Mapping {len(self.routes_ids)} geofences to routes, {len(changed)} vehicles changed route")
+
+    def reload_routes(self) -> int:
+        # Reads routes_path again, the Traccar geofences are fetched again on every connection
+        self._configured_routes = load_routes(ROUTES_PATH)
+        changes = self._changes
+
+        self._set_routes()
+
+        if self._changes != changes:
+            for listener in self._listeners:
+                listener()
+
+        return len(self.routes_ids)
+
+    def _mark_dirty(self, device_id) -> None:
+        self._changes += 1
+
+        with self._dirty_lock:
+            for dirty in self._dirty.values():
+                dirty.add(device_id)
+
+    def mark_all_dirty(self) -> None:
+        for device_id in self.data:
+            self._mark_dirty(device_id)
+
+        for listener in self._listeners:
+            listener()
+
+    def take_dirty(self, consumer: str) -> Set[Any]:
+        # The first call of a consumer gets every device, later ones only what changed since
+        with self._dirty_lock:
+            if consumer not in self._dirty:
+                self._dirty[consumer] = set()
+                return set(self.data)
+
+            dirty = self._dirty[consumer]
+            self._dirty[consumer] = set()
+
+        return dirty
+
+    def return_dirty(self, consumer: str, device_ids: Set[Any]) -> None:
+        # Devices a consumer failed to build, taken again by its next round
+        with self._dirty_lock:
+            self._dirty.setdefault(consumer, set()).update(device_ids)
+
     def test_events(self) -> None:
         alternate = True
 
         for data in self.data.values():
-            device_id = data["id"]
+            device_id = data.id
 
             now = datetime.now()
 
@@ -82,7 +235,7 @@ class DataContext(metaclass=SingletonMeta):
                 "id": device_id,
                 "deviceId": device_id,
                 "eventTime": now.strftime("%Y-%m-%dT%H:%M:%S.000+00:00"),
-                "positionId": data.get("positionId", 0),
+                "positionId": data.position_id or 0,
                 "geofenceId": 0,
                 "maintenanceId": 0,
                 "busStopId": 0
@@ -103,15 +256,217 @@ class DataContext(metaclass=SingletonMeta):
                     "attributes": {}
                 }
 
-            data["event"] = event
+            self._apply_event(data, VehicleEvent(event))
             
             alternate = not alternate
 
 
+class GtfsData:
+    # One complete, immutable load of the static feed
+    def __init__(self, tables, schedule: Schedule, shapes: Optional[ShapeIndex]):
+        self.trips = tables["trips"]
+        self.stops = tables["stops"]
+        self.calendar = tables["calendar"]
+        self.calendar_dates = tables.get("calendar_dates")
+        self.schedule = schedule
+        self.shapes = shapes
+
+        self.services = ServiceCalendar(self.calendar, self.calendar_dates)
+
+        # trip_id -> meters along the shape of each stop, filled on first use
+        self._stop_distances: Dict[str, Optional[np.ndarray]] = {}
+        # Grid cell -> routes whose shapes pass through it, built on first use
+        self._route_cells: Optional[Dict[Tuple[int, int], FrozenSet[str]]] = None
+
+    def nearest_trip(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[str]:
+        return self.schedule.nearest_trip(route_id, service_ids, seconds)
+
+    def nearest_departure(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[Tuple[int, str]]:
+        return self.schedule.nearest_departure(route_id, service_ids, seconds)
+
+    def active_services(self, day: date) -> FrozenSet[str]:
+        return self.services.active_services(day)
+
+    def trip_stops(self, trip_id: str) -> Sequence[Dict[str, Any]]:
+        return self.schedule.trip_stops(trip_id)
+
+    def trip_arrays(self, trip_id: str) -> Optional[TripArrays]:
+        return self.schedule.trip_arrays(trip_id)
+
+    def trip_shape(self, trip_id: str) -> Optional[str]:
+        shape_id = self.schedule.trip_shape(trip_id)
+
+        if self.shapes is None or shape_id is None or not self.shapes.has_shape(shape_id):
+            return None
+
+        return shape_id
+
+    def routes_near(self, latitude: float, longitude: float) -> FrozenSet[str]:
+        if self.shapes is None:
+            return frozenset()
+
+        if self._route_cells is None:
+            self._route_cells = self._build_route_cells()
+
+        return self._route_cells.get(self.shapes.cell(latitude, longitude), frozenset())
+
+    def _build_route_cells(self) -> Dict[Tuple[int, int], FrozenSet[str]]:
+        trips = self.trips.dropna(subset=["shape_id"])
+        routes_by_shape: Dict[str, Set[str]] = {}
+        for shape_id, route_id in zip(trips["shape_id"].astype(str), trips["route_id"].astype(str)):
+            routes_by_shape.setdefault(shape_id, set()).add(route_id)
+
+        shape_routes = [frozenset(routes_by_shape.get(shape_id, ())) for shape_id in self.shapes.shape_ids.tolist()]
+
+        route_cells = {}
+        for cell, shapes in self.shapes.cell_shapes().items():
+            routes = frozenset().union(*(shape_routes[shape] for shape in shapes.tolist()))
+            if routes:
+                route_cells[cell] = routes
+
+        logger.info(f"Route grid built with {len(route_cells)} cells")
+
+        return route_cells
+
+    def stop_distances(self, trip_id: str) -> Optional[np.ndarray]:
+        if trip_id not in self._stop_distances:
+            shape_id = self.trip_shape(trip_id)
+            trip_arrays = self.trip_arrays(trip_id)
+
+            distances = None
+            if shape_id is not None and trip_arrays is not None:
+                distances = self.shapes.snap_sequence(shape_id, trip_arrays.stop_lat, trip_arrays.stop_lon)
+
+            self._stop_distances[trip_id] = distances
+
+        return self._stop_distances[trip_id]
+
+
 class GtfsDataContext(metaclass=SingletonMeta):
+    # Files whose compiled form is cached, shapes.txt and one of the calendars are optional
+    FILES = ["trips.txt", "stops.txt", "calendar.txt", "calendar_dates.txt", "stop_times.txt", "shapes.txt"]
+
     def __init__(self):
+        # Nothing is read until the first use, or an explicit load() at startup
+        self._data: Optional[GtfsData] = None
+        self._lock = threading.Lock()
+        self._reloading = False
+        # A reload was asked for while one was running
+        self._reload_pending = False
+        # Called after a reload swapped the data, see add_listener
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def trips(self) -> pd.DataFrame:
+        return self.current().trips
+
+    @property
+    def stops(self) -> pd.DataFrame:
+        return self.current().stops
+
+    @property
+    def calendar(self) -> Optional[pd.DataFrame]:
+        return self.current().calendar
+
+    @property
+    def schedule(self) -> Schedule:
+        return self.current().schedule
+
+    @property
+    def shapes(self) -> Optional[ShapeIndex]:
+        return self.current().shapes
+
+    def current(self) -> GtfsData:
+        # Callers doing several lookups should keep this, a reload may swap it meanwhile
+        data = self._data
+        if data is None:
+            self.load()
+            data = self._data
+
+        return data
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+
+    def load(self) -> None:
+        with self._lock:
+            if self._data is None:
+                self._data = self._read()
+
+    async def reload(self) -> bool:
+        # Returns False if a reload is already running, it reads the files again once it's done
+        if self._reloading:
+            self._reload_pending = True
+            return False
+
+        self._reloading = True
+        try:
+            while True:
+                self._reload_pending = False
+
+                # Built aside while requests keep using the current data
+                data = await asyncio.to_thread(self._read)
+
+                # A single reference swap, readers see either the old or the new feed
+                self._data = data
+
+                for listener in self._listeners:
+                    listener()
+
+                logger.info("GTFS data reloaded")
+
+                # Files changed during the read may not be in it
+                if not self._reload_pending:
+                    break
+        finally:
+            self._reloading = False
+
+        return True
+
+    async def watch(self) -> None:
+        # Reload whenever the GTFS files change, ignoring our own cache
+        changed = lambda _, path: path.endswith(".txt") and ".cache" not in Path(path).parts
+
+        async for changes in awatch(GTFS_PATH, watch_filter=changed):
+            logger.info(f"GTFS files changed: {sorted(Path(path).name for _, path in changes)}")
+
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"GTFS reload failed, keeping the current data: {e}")
+
+    def _read(self) -> GtfsData:
+        start_time = time()
+
+        cache = GtfsCache(GTFS_PATH / ".cache")
+        key = cache.key(GTFS_PATH / name for name in self.FILES)
+
+        cached = cache.load(key)
+
+        if cached is not None:
+            tables, arrays = cached
+            shape_arrays = _section(arrays, "shapes")
+            data = GtfsData(tables, Schedule(_section(arrays, "schedule")), ShapeIndex(shape_arrays) if shape_arrays else None)
+            logger.info(f"GTFS data loaded from cache in {(time() - start_time):.3f}s")
+            return data
+
+        tables, schedule, shapes = self._read_csv()
+
+        try:
+            cache.save(key, tables, {
+                **{f"schedule.{name}": array for name, array in schedule.to_arrays().items()},
+                **{f"shapes.{name}": array for name, array in (shapes.to_arrays() if shapes else {}).items()}
+            })
+        except OSError as e:
+            logger.warning(f"Could not write the GTFS cache: {e}")
+
+        logger.info(f"GTFS data loaded successfully in {(time() - start_time):.3f}s")
+
+        return GtfsData(tables, schedule, shapes)
+
+    def _read_csv(self):
         # Load GTFS data with optimized dtype specifications for memory efficiency
-        self.trips = pd.read_csv(
+        trips = pd.read_csv(
             GTFS_PATH / "trips.txt",
             dtype={
                 'route_id': 'int32',
@@ -123,7 +478,7 @@ class GtfsDataContext(metaclass=SingletonMeta):
             }
         )
         
-        self.stops = pd.read_csv(
+        stops = pd.read_csv(
             GTFS_PATH / "stops.txt",
             dtype={
                 'stop_id': 'str',
@@ -133,44 +488,99 @@ class GtfsDataContext(metaclass=SingletonMeta):
             }
         )
         
-        self.calendar = pd.read_csv(
-            GTFS_PATH / "calendar.txt",
-            dtype={
-                'service_id': 'category',
-                'monday': 'int8',
-                'tuesday': 'int8',
-                'wednesday': 'int8',
-                'thursday': 'int8',
-                'friday': 'int8',
-                'saturday': 'int8',
-                'sunday': 'int8',
-                'start_date': 'int32',
-                'end_date': 'int32'
-            }
-        )
+        # Services can be defined by calendar.txt, calendar_dates.txt or both
+        calendar = None
+        if (GTFS_PATH / "calendar.txt").exists():
+            calendar = pd.read_csv(
+                GTFS_PATH / "calendar.txt",
+                dtype={
+                    'service_id': 'category',
+                    'monday': 'int8',
+                    'tuesday': 'int8',
+                    'wednesday': 'int8',
+                    'thursday': 'int8',
+                    'friday': 'int8',
+                    'saturday': 'int8',
+                    'sunday': 'int8',
+                    'start_date': 'int32',
+                    'end_date': 'int32'
+                }
+            )
+
+        calendar_dates = None
+        if (GTFS_PATH / "calendar_dates.txt").exists():
+            calendar_dates = pd.read_csv(
+                GTFS_PATH / "calendar_dates.txt",
+                dtype={
+                    'service_id': 'category',
+                    'date': 'int32',
+                    'exception_type': 'int8'
+                }
+            )
         
-        self.stop_times = pd.read_csv(
+        # Only what Schedule compiles is read, ids as categoricals and times as
+        # strings that are turned into seconds without strptime
+        stop_times = pd.read_csv(
             GTFS_PATH / "stop_times.txt",
             dtype={
-                'trip_id': 'str',
+                'trip_id': 'category',
                 'arrival_time': 'str',
                 'departure_time': 'str',
-                'stop_id': 'str',
+                'stop_id': 'category',
                 'stop_sequence': 'int16'
-            }
+            },
+            usecols=['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
         )
         
-        # Pre-process stop_times to optimize frequently used queries
-        self._prepare_stop_times_index()
-        
-        logger.info("GTFS data loaded successfully")
-        
-    def _prepare_stop_times_index(self):
-        # Create an index on trip_id for faster lookup
-        self.stop_times.set_index('trip_id', inplace=True)
-        self.stop_times.sort_index(inplace=True)
-        
-        # We'll reset it when needed in specific queries
+        # shapes.txt is optional in GTFS, without it vehicle progress isn't tracked
+        shapes = None
+        if (GTFS_PATH / "shapes.txt").exists():
+            shapes = ShapeIndex.build(pd.read_csv(
+                GTFS_PATH / "shapes.txt",
+                dtype={
+                    'shape_id': 'str',
+                    'shape_pt_lat': 'float64',
+                    'shape_pt_lon': 'float64',
+                    'shape_pt_sequence': 'int32'
+                },
+                usecols=['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']
+            ))
+
+        # Compile stop_times into the arrays used by the frequent queries
+        schedule = Schedule.build(trips, stops, stop_times)
+
+        return {"trips": trips, "stops": stops, "calendar": calendar, "calendar_dates": calendar_dates}, schedule, shapes
+
+    def nearest_trip(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[str]:
+        return self.current().nearest_trip(route_id, service_ids, seconds)
+
+    def nearest_departure(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[Tuple[int, str]]:
+        return self.current().nearest_departure(route_id, service_ids, seconds)
+
+    def active_services(self, day: date) -> FrozenSet[str]:
+        return self.current().active_services(day)
+
+    def trip_stops(self, trip_id: str) -> Sequence[Dict[str, Any]]:
+        return self.current().trip_stops(trip_id)
+
+    def trip_arrays(self, trip_id: str) -> Optional[TripArrays]:
+        return self.current().trip_arrays(trip_id)
+
+    def trip_shape(self, trip_id: str) -> Optional[str]:
+        return self.current().trip_shape(trip_id)
+
+    def stop_distances(self, trip_id: str) -> Optional[np.ndarray]:
+        return self.current().stop_distances(trip_id)
+
+    def routes_near(self, latitude: float, longitude: float) -> FrozenSet[str]:
+        return self.current().routes_near(latitude, longitude)
+
+
+def _section(arrays: Dict[str, np.ndarray], prefix: str) -> Dict[str, np.ndarray]:
+    return {name[len(prefix) + 1:]: array for name, array in arrays.items() if name.startswith(f"{prefix}.")}
 
 context: DataContext = DataContext()
-gtfs_context: GtfsDataContext = GtfsDataContext()
\ No newline at end of file
+gtfs_context: GtfsDataContext = GtfsDataContext()
+
+# Trips may have changed, every vehicle needs its entities rebuilt
+gtfs_context.add_listener(context.mark_all_dirty)
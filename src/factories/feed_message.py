@@ -8,10 +8,11 @@ class FeedMessage:
     @staticmethod
     def create(*args, **kwargs):
         entities = kwargs.get("entities", {})
+        incrementality = kwargs.get("incrementality", "FULL_DATASET")
 
         header = gtfsrt.FeedHeader(
             gtfs_realtime_version=FeedMessage.VERSION,
-            incrementality=gtfsrt.FeedHeader.FULL_DATASET,
+            incrementality=gtfsrt.FeedHeader.Incrementality.Value(incrementality),
             timestamp = int(time.time())
         )
 
@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 from google.transit import gtfs_realtime_pb2 as gtfsrt
 
 class ServiceAlert:
@@ -7,9 +7,14 @@ class ServiceAlert:
         entity_id = str(kwargs.get("entity_id"))
         route_id = str(kwargs.get("route_id"))
 
-        # Parse event time string and get timestamp
-        event_time_str = kwargs.get("event_time")
-        start_time = int(datetime.fromisoformat(event_time_str.replace("Z", "+00:00")).timestamp())
+        # UNIX start time, or parsed from the event time string
+        start_time = kwargs.get("start_time")
+        if start_time is None:
+            event_time_str = kwargs.get("event_time")
+            start_time = int(datetime.fromisoformat(event_time_str.replace("Z", "+00:00")).timestamp())
+
+        # Open ended until the alert is closed
+        end_time = kwargs.get("end_time")
 
         header_text = kwargs.get("header_text", "Service Disruption")
         description_text = kwargs.get("description_text", "Detailed description of the service disruption")
@@ -18,7 +23,9 @@ class ServiceAlert:
         effect = gtfsrt.Alert.Effect.DETOUR
 
         # Alert - Time active
-        active_period = gtfsrt.TimeRange(start=start_time)
+        active_period = gtfsrt.TimeRange(start=int(start_time))
+        if end_time is not None:
+            active_period.end = int(end_time)
 
         # Alert - Entities this alert informs
         informed_entity = gtfsrt.EntitySelector(
@@ -32,6 +32,7 @@ class VehiclePosition:
 
         current_stop_sequence = kwargs.get("current_stop_sequence")
         stop_id = str(kwargs.get("stop_id"))
+        current_status = kwargs.get("current_status", "STOPPED_AT")
 
         # VehiclePosition: encapsulates the real-time vehicle data
         vehicle_position = gtfsrt.VehiclePosition(
@@ -39,7 +40,7 @@ class VehiclePosition:
             trip=trip_descriptor,
             vehicle=vehicle_descriptor,
             current_stop_sequence=current_stop_sequence,
-            current_status=gtfsrt.VehiclePosition.VehicleStopStatus.STOPPED_AT,
+            current_status=gtfsrt.VehiclePosition.VehicleStopStatus.Value(current_status),
             stop_id=stop_id,
             timestamp=int(datetime.now().timestamp())
         )
@@ -0,0 +1,70 @@
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class GtfsCache:
+    # Bump when the compiled layout changes, so stale caches are rebuilt
+    FORMAT_VERSION = 3
+
+    def __init__(self, directory: Path) -> None:
+        self._directory = directory
+
+    def key(self, files: Iterable[Path]) -> str:
+        # Size and modification time identify a GTFS file without reading it
+        digest = hashlib.sha1(f"v{self.FORMAT_VERSION}".encode())
+
+        for path in files:
+            if path.exists():
+                stat = path.stat()
+                digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+
+        return digest.hexdigest()
+
+    def load(self, key: str) -> Optional[Tuple[Dict[str, Any], Dict[str, np.ndarray]]]:
+        directory = self._directory / key
+        if not (directory / "tables.pkl").exists():
+            return None
+
+        tables = pd.read_pickle(directory / "tables.pkl")
+
+        # Arrays are memory-mapped, pages are read from disk only when touched
+        arrays = {
+            path.stem: np.load(path, mmap_mode="r", allow_pickle=False)
+            for path in directory.glob("*.npy")
+        }
+
+        return tables, arrays
+
+    def save(self, key: str, tables: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+        # Written aside and renamed, so a reader never sees a half written cache
+        staging = self._directory / f".{key}.{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir()
+
+        for name, array in arrays.items():
+            np.save(staging / f"{name}.npy", np.ascontiguousarray(array), allow_pickle=False)
+
+        pd.to_pickle(tables, staging / "tables.pkl")
+
+        try:
+            staging.rename(self._directory / key)
+        except OSError:
+            # Another process cached the same files first
+            shutil.rmtree(staging, ignore_errors=True)
+
+        # Only the cache of the current files is kept
+        for path in self._directory.iterdir():
+            if path.name != key and not path.name.startswith("."):
+                shutil.rmtree(path, ignore_errors=True)
+
+        logger.info(f"GTFS cache written to {self._directory / key}")
@@ -0,0 +1,59 @@
+import logging
+import pandas as pd
+
+from datetime import date
+from typing import Dict, FrozenSet, Optional
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# calendar_dates.txt exception_type
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+class ServiceCalendar:
+    # Services running on each date, from calendar.txt and the exceptions of
+    # calendar_dates.txt. Worked out once per date and kept for a few days.
+    MAX_DATES = 4
+
+    def __init__(self, calendar: Optional[pd.DataFrame], calendar_dates: Optional[pd.DataFrame]) -> None:
+        self._calendar = calendar
+        self._calendar_dates = calendar_dates
+        # YYYYMMDD -> active service_ids, oldest date first
+        self._services: Dict[int, FrozenSet[str]] = {}
+
+    def active_services(self, day: date) -> FrozenSet[str]:
+        key = day.year * 10000 + day.month * 100 + day.day
+
+        services = self._services.get(key)
+        if services is None:
+            services = self._compute(key, WEEKDAYS[day.weekday()])
+            self._services[key] = services
+
+            # Positions move to a new service day at midnight, the old ones aren't asked for again
+            while len(self._services) > self.MAX_DATES:
+                del self._services[min(self._services)]
+
+        return services
+
+    def _compute(self, key: int, weekday: str) -> FrozenSet[str]:
+        services = set()
+
+        calendar = self._calendar
+        if calendar is not None and len(calendar):
+            running = (calendar[weekday] == 1) & (calendar["start_date"] <= key) & (calendar["end_date"] >= key)
+            services.update(calendar.loc[running, "service_id"].astype(str))
+
+        calendar_dates = self._calendar_dates
+        if calendar_dates is not None and len(calendar_dates):
+            exceptions = calendar_dates[calendar_dates["date"] == key]
+            exception_types = exceptions["exception_type"].to_numpy()
+            service_ids = exceptions["service_id"].astype(str).to_numpy()
+
+            services.update(service_ids[exception_types == SERVICE_ADDED])
+            services.difference_update(service_ids[exception_types == SERVICE_REMOVED])
+
+        logger.info(f"{len(services)} services active on {key}")
+
+        return frozenset(services)
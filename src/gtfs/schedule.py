@@ -0,0 +1,288 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+class TripArrays(NamedTuple):
+    stop_sequence: np.ndarray
+    stop_lat: np.ndarray
+    stop_lon: np.ndarray
+    # Scheduled arrival, in seconds since the service day midnight
+    arrival: np.ndarray
+
+
+class TripStops(Sequence):
+    # The stops of one trip as a view over the schedule rows, a stop's dict is
+    # only built when it's asked for
+    __slots__ = ("_schedule", "_start", "_stop")
+
+    def __init__(self, schedule: "Schedule", rows: slice) -> None:
+        self._schedule = schedule
+        self._start = rows.start
+        self._stop = rows.stop
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("stop index out of range")
+
+        row = self._start + index
+        schedule = self._schedule
+        arrival = int(schedule.st_arrival[row])
+
+        return {
+            "stop_sequence": int(schedule.st_stop_sequence[row]),
+            "stop_id": str(schedule.stop_ids[schedule.st_stop[row]]),
+            "stop_lat": float(schedule.stop_lat[schedule.st_stop[row]]),
+            "stop_lon": float(schedule.stop_lon[schedule.st_stop[row]]),
+            "arrival": arrival,
+            "arrival_time": seconds_to_time(arrival)
+        }
+
+    @property
+    def arrays(self) -> TripArrays:
+        return self._schedule.arrays_at(slice(self._start, self._stop))
+
+
+class Schedule:
+    # Compiled stop_times: trips are contiguous row ranges given by trip_offsets,
+    # and every per-row column is a plain array that can be saved and memory-mapped
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.trip_ids = arrays["trip_ids"]
+        self.trip_offsets = arrays["trip_offsets"]
+        self.trip_shape_ids = arrays["trip_shape_ids"]
+
+        # Per stop, stop_times rows point into these with st_stop
+        self.stop_ids = arrays["stop_ids"]
+        self.stop_lat = arrays["stop_lat"]
+        self.stop_lon = arrays["stop_lon"]
+
+        self.st_stop = arrays["st_stop"]
+        self.st_stop_sequence = arrays["st_stop_sequence"]
+        self.st_arrival = arrays["st_arrival"]
+
+        self.dep_routes = arrays["dep_routes"]
+        self.dep_services = arrays["dep_services"]
+        self.dep_offsets = arrays["dep_offsets"]
+        self.dep_seconds = arrays["dep_seconds"]
+        self.dep_trips = arrays["dep_trips"]
+
+        self._trip_index: Dict[str, int] = {trip_id: i for i, trip_id in enumerate(self.trip_ids.tolist())}
+
+        # (route_id, service_id) -> (sorted first departures in seconds, matching trip indexes)
+        self._departures: Dict[Tuple[int, str], Tuple[np.ndarray, np.ndarray]] = {}
+        for i, (route_id, service_id) in enumerate(zip(self.dep_routes.tolist(), self.dep_services.tolist())):
+            rows = slice(int(self.dep_offsets[i]), int(self.dep_offsets[i + 1]))
+            self._departures[(route_id, service_id)] = (self.dep_seconds[rows], self.dep_trips[rows])
+
+    @classmethod
+    def build(cls, trips: pd.DataFrame, stops: pd.DataFrame, stop_times: pd.DataFrame) -> "Schedule":
+        # trip_id and stop_id are best read as categoricals, rows are then grouped by their integer codes
+        stop_times = stop_times.assign(
+            trip_id=stop_times["trip_id"].astype("category"),
+            stop_id=stop_times["stop_id"].astype("category")
+        )
+
+        # Sort by trip and sequence so every trip is a contiguous block of rows
+        stop_times = stop_times.sort_values(["trip_id", "stop_sequence"], kind="stable").reset_index(drop=True)
+
+        stops = stops.drop_duplicates("stop_id")
+        stop_ids = stop_times["stop_id"].cat
+        st_stop = pd.Index(stops["stop_id"]).get_indexer(stop_ids.categories)[stop_ids.codes]
+        st_stop[stop_ids.codes < 0] = -1
+
+        # Drop stop_times pointing to stops missing from stops.txt
+        known = st_stop >= 0
+        if not known.all():
+            logger.warning(f"Ignoring {int((~known).sum())} stop_times with unknown stop_id")
+            stop_times = stop_times[known].reset_index(drop=True)
+            st_stop = st_stop[known]
+
+        trip_codes = stop_times["trip_id"].cat.codes.to_numpy()
+        starts = np.flatnonzero(np.r_[True, trip_codes[1:] != trip_codes[:-1]]) if len(trip_codes) else np.array([], dtype=np.int64)
+        trip_ids = stop_times["trip_id"].cat.categories.to_numpy(dtype=str)[trip_codes[starts]]
+
+        trip_info = trips.drop_duplicates("trip_id").set_index("trip_id").reindex(trip_ids)
+        shape_ids = trip_info["shape_id"] if "shape_id" in trip_info else pd.Series(index=trip_info.index, dtype=object)
+
+        trip_offsets = np.r_[starts, len(trip_codes)].astype(np.int64)
+
+        arrays = {
+            "trip_ids": trip_ids.astype(str),
+            "trip_offsets": trip_offsets,
+            "trip_shape_ids": shape_ids.astype(object).fillna("").to_numpy(dtype=str),
+            "stop_ids": stops["stop_id"].to_numpy(dtype=str),
+            "stop_lat": stops["stop_lat"].to_numpy(dtype=np.float64),
+            "stop_lon": stops["stop_lon"].to_numpy(dtype=np.float64),
+            "st_stop": st_stop.astype(np.int32),
+            "st_stop_sequence": stop_times["stop_sequence"].to_numpy(dtype=np.int16),
+            "st_arrival": time_to_seconds(stop_times["arrival_time"], trip_offsets),
+        }
+
+        # First departure of every trip, grouped by (route_id, service_id) and sorted by time.
+        # Without a departure time the trip leaves at its first arrival, as filled within the trip
+        first_departures = stop_times["departure_time"].iloc[starts]
+        departure = np.where(first_departures.notna().to_numpy(), time_to_seconds(first_departures, np.arange(len(starts) + 1)), arrays["st_arrival"][starts])
+        in_trips = trip_info["route_id"].notna().to_numpy() & trip_info["service_id"].notna().to_numpy()
+
+        trip_rows = np.flatnonzero(in_trips)
+        routes = trip_info["route_id"].to_numpy()[trip_rows].astype(np.int32)
+        services = trip_info["service_id"].astype(object).to_numpy()[trip_rows].astype(str)
+        departure = departure[trip_rows]
+
+        order = np.lexsort((departure, services, routes))
+        routes, services, departure, trip_rows = routes[order], services[order], departure[order], trip_rows[order]
+
+        group_starts = np.flatnonzero(np.r_[True, (routes[1:] != routes[:-1]) | (services[1:] != services[:-1])]) if len(routes) else np.array([], dtype=np.int64)
+
+        arrays.update({
+            "dep_routes": routes[group_starts],
+            "dep_services": services[group_starts],
+            "dep_offsets": np.r_[group_starts, len(routes)].astype(np.int64),
+            "dep_seconds": departure,
+            "dep_trips": trip_rows.astype(np.int32),
+        })
+
+        return cls(arrays)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "trip_ids": self.trip_ids,
+            "trip_offsets": self.trip_offsets,
+            "trip_shape_ids": self.trip_shape_ids,
+            "stop_ids": self.stop_ids,
+            "stop_lat": self.stop_lat,
+            "stop_lon": self.stop_lon,
+            "st_stop": self.st_stop,
+            "st_stop_sequence": self.st_stop_sequence,
+            "st_arrival": self.st_arrival,
+            "dep_routes": self.dep_routes,
+            "dep_services": self.dep_services,
+            "dep_offsets": self.dep_offsets,
+            "dep_seconds": self.dep_seconds,
+            "dep_trips": self.dep_trips,
+        }
+
+    def nearest_trip(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[str]:
+        nearest = self.nearest_departure(route_id, service_ids, seconds)
+        return nearest[1] if nearest is not None else None
+
+    def nearest_departure(self, route_id, service_ids: Iterable[str], seconds: int) -> Optional[Tuple[int, str]]:
+        # (seconds between the first departure and the given time, trip_id) of the closest trip
+        best_trip = None
+        best_diff = None
+
+        # Departures are keyed by the numeric route_id, any other route has no trips
+        try:
+            route = int(route_id)
+        except (TypeError, ValueError):
+            return None
+
+        for service_id in service_ids:
+            entry = self._departures.get((route, str(service_id)))
+            if entry is None:
+                continue
+
+            departures, trips = entry
+            i = int(np.searchsorted(departures, seconds))
+
+            # The closest departure is one of the two neighbours of the insertion point
+            for j in (i - 1, i):
+                if 0 <= j < len(departures):
+                    diff = abs(int(departures[j]) - seconds)
+                    if best_diff is None or diff < best_diff:
+                        best_diff = diff
+                        best_trip = int(trips[j])
+
+        return (best_diff, str(self.trip_ids[best_trip])) if best_trip is not None else None
+
+    def trip_rows(self, trip_id: str) -> Optional[slice]:
+        trip = self._trip_index.get(trip_id)
+        if trip is None:
+            return None
+
+        return slice(int(self.trip_offsets[trip]), int(self.trip_offsets[trip + 1]))
+
+    def trip_shape(self, trip_id: str) -> Optional[str]:
+        trip = self._trip_index.get(trip_id)
+        if trip is None:
+            return None
+
+        return str(self.trip_shape_ids[trip]) or None
+
+    def trip_stops(self, trip_id: str) -> Sequence[Dict[str, Any]]:
+        rows = self.trip_rows(trip_id)
+        if rows is None:
+            return []
+
+        return TripStops(self, rows)
+
+    def trip_arrays(self, trip_id: str) -> Optional[TripArrays]:
+        rows = self.trip_rows(trip_id)
+        if rows is None:
+            return None
+
+        return self.arrays_at(rows)
+
+    def arrays_at(self, rows: slice) -> TripArrays:
+        # Views into the stop_times columns, only the coordinates of the trip's stops are gathered
+        stops = self.st_stop[rows]
+
+        return TripArrays(
+            stop_sequence=self.st_stop_sequence[rows],
+            stop_lat=self.stop_lat[stops],
+            stop_lon=self.stop_lon[stops],
+            arrival=self.st_arrival[rows]
+        )
+
+
+def time_to_seconds(times: pd.Series, trip_offsets: np.ndarray) -> np.ndarray:
+    # GTFS times are "H:MM:SS" and may go past 24:00:00, so strptime can't be used.
+    # The digits are read straight from the bytes of every value, right aligned.
+    raw = times.to_numpy(dtype="S9")
+    digits = raw.view(np.uint8).reshape(-1, 9).astype(np.int32) - ord("0")
+    length = (raw.view(np.uint8).reshape(-1, 9) != 0).sum(axis=1)
+
+    rows = np.arange(len(digits))
+    last = np.clip(length - 1, 5, 8)
+
+    # "H:MM:SS" or "HH:MM:SS" with digits everywhere but the two colons
+    positions = np.arange(9)
+    colons = (positions == (last - 2)[:, None]) | (positions == (last - 5)[:, None])
+    digit_ok = (digits >= 0) & (digits <= 9)
+    valid = (
+        ((length == 7) | (length == 8))
+        & np.where(colons, digits == ord(":") - ord("0"), digit_ok | (positions >= length[:, None])).all(axis=1)
+    )
+
+    seconds = digits[rows, last - 1] * 10 + digits[rows, last]
+    minutes = digits[rows, last - 4] * 10 + digits[rows, last - 3]
+    hours = np.where(length == 8, digits[:, 0] * 10 + digits[:, 1], digits[:, 0])
+
+    result = (hours * 3600 + minutes * 60 + seconds).astype(np.float64)
+
+    # Padded, longer or missing values take the slow path
+    if not valid.all():
+        odd = ~valid
+        result[odd] = pd.to_timedelta(times[odd].astype(str).str.strip(), errors="coerce").dt.total_seconds().to_numpy()
+
+        # Stops without a time (not timepoints) take the one of the stop before in their trip, never
+        # the last one of the trip before, and a trip's first stops the one of the stop after
+        trips = np.repeat(np.arange(len(trip_offsets) - 1), np.diff(trip_offsets))
+        result = pd.Series(result).groupby(trips).ffill().groupby(trips).bfill().fillna(0).to_numpy()
+
+    return result.astype(np.int32)
+
+
+def seconds_to_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
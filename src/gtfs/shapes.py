@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Meters per degree of latitude on the mean earth sphere
+METERS_PER_DEGREE = 6371008.8 * np.pi / 180
+
+class Snap(NamedTuple):
+    # Global index of the shape segment the point was snapped to
+    segment: int
+    # Meters travelled along the shape up to the snapped point
+    distance: float
+    # Meters between the point and the shape
+    offset: float
+
+
+class ShapeIndex:
+    # Size of the grid cells used to find segments near a point
+    CELL_SIZE_M = 250
+    # Segments searched behind and ahead of the previous snap
+    WINDOW_BEHIND = 3
+    WINDOW_AHEAD = 30
+    # A windowed snap farther than this from the shape falls back to the grid
+    MAX_WINDOW_OFFSET_M = 100
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.x = arrays["x"]
+        self.y = arrays["y"]
+        self.distance = arrays["distance"]
+
+        self.shape_ids = arrays["shape_ids"]
+        self.shape_offsets = arrays["shape_offsets"]
+
+        self.grid_cells = arrays["grid_cells"]
+        self.grid_offsets = arrays["grid_offsets"]
+        self.grid_segments = arrays["grid_segments"]
+
+        self.origin = arrays["origin"]
+        self._lat0, self._lon0 = (float(value) for value in self.origin)
+        self._kx = METERS_PER_DEGREE * np.cos(np.radians(self._lat0))
+
+        # shape_id -> (first point, last point + 1)
+        self._shapes: Dict[str, Tuple[int, int]] = {
+            shape_id: (start, end)
+            for shape_id, start, end in zip(self.shape_ids.tolist(), self.shape_offsets[:-1].tolist(), self.shape_offsets[1:].tolist())
+        }
+
+        # (cell x, cell y) -> segments registered in that cell
+        self._grid: Dict[Tuple[int, int], np.ndarray] = {
+            (cx, cy): self.grid_segments[start:end]
+            for (cx, cy), start, end in zip(self.grid_cells.tolist(), self.grid_offsets[:-1].tolist(), self.grid_offsets[1:].tolist())
+        }
+
+    @classmethod
+    def build(cls, shapes: pd.DataFrame) -> "ShapeIndex":
+        shapes = shapes.sort_values(["shape_id", "shape_pt_sequence"], kind="stable")
+
+        latitude = shapes["shape_pt_lat"].to_numpy(dtype=np.float64)
+        longitude = shapes["shape_pt_lon"].to_numpy(dtype=np.float64)
+
+        # Local equirectangular projection around the feed center, in meters
+        lat0 = float(latitude.mean()) if len(latitude) else 0.0
+        lon0 = float(longitude.mean()) if len(longitude) else 0.0
+        kx = METERS_PER_DEGREE * np.cos(np.radians(lat0))
+
+        x = ((longitude - lon0) * kx).astype(np.float32)
+        y = ((latitude - lat0) * METERS_PER_DEGREE).astype(np.float32)
+
+        shape_ids = shapes["shape_id"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, shape_ids[1:] != shape_ids[:-1]]) if len(shape_ids) else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(shape_ids)].astype(np.int64)
+
+        # Segment i joins point i and i + 1, the last point of a shape starts no segment
+        segment_length = np.hypot(np.diff(x.astype(np.float64)), np.diff(y.astype(np.float64)))
+        segment_length = np.r_[segment_length, 0.0]
+        segment_length[ends - 1] = 0.0
+
+        # Distance travelled along its shape at every point
+        distance = np.r_[0.0, np.cumsum(segment_length)[:-1]]
+        distance -= np.repeat(distance[starts], ends - starts)
+
+        grid_cells, grid_offsets, grid_segments = cls._build_grid(x, y, ends)
+
+        return cls({
+            "x": x,
+            "y": y,
+            "distance": distance.astype(np.float32),
+            "shape_ids": shape_ids[starts].astype(str),
+            "shape_offsets": np.r_[starts, len(shape_ids)].astype(np.int64),
+            "grid_cells": grid_cells,
+            "grid_offsets": grid_offsets,
+            "grid_segments": grid_segments,
+            "origin": np.array([lat0, lon0], dtype=np.float64),
+        })
+
+    @classmethod
+    def _build_grid(cls, x, y, ends):
+        is_segment = np.ones(len(x), dtype=bool)
+        is_segment[ends - 1] = False
+        segments = np.flatnonzero(is_segment)
+
+        cx0 = np.floor(np.minimum(x[segments], x[segments + 1]) / cls.CELL_SIZE_M).astype(np.int64)
+        cx1 = np.floor(np.maximum(x[segments], x[segments + 1]) / cls.CELL_SIZE_M).astype(np.int64)
+        cy0 = np.floor(np.minimum(y[segments], y[segments + 1]) / cls.CELL_SIZE_M).astype(np.int64)
+        cy1 = np.floor(np.maximum(y[segments], y[segments + 1]) / cls.CELL_SIZE_M).astype(np.int64)
+
+        # Register every segment in all the cells its bounding box touches
+        cells: Dict[Tuple[int, int], list] = {}
+        for segment, x0, x1, y0, y1 in zip(segments.tolist(), cx0.tolist(), cx1.tolist(), cy0.tolist(), cy1.tolist()):
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    cells.setdefault((cx, cy), []).append(segment)
+
+        # Stored CSR style so the grid can be saved as plain arrays
+        grid_cells = np.array(list(cells.keys()), dtype=np.int32).reshape(-1, 2)
+        grid_offsets = np.r_[0, np.cumsum([len(members) for members in cells.values()])].astype(np.int64)
+        grid_segments = np.array([segment for members in cells.values() for segment in members], dtype=np.int32)
+
+        return grid_cells, grid_offsets, grid_segments
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "x": self.x,
+            "y": self.y,
+            "distance": self.distance,
+            "shape_ids": self.shape_ids,
+            "shape_offsets": self.shape_offsets,
+            "grid_cells": self.grid_cells,
+            "grid_offsets": self.grid_offsets,
+            "grid_segments": self.grid_segments,
+            "origin": self.origin,
+        }
+
+    def has_shape(self, shape_id) -> bool:
+        return str(shape_id) in self._shapes
+
+    def project(self, latitude, longitude):
+        x = (np.asarray(longitude, dtype=np.float64) - self._lon0) * self._kx
+        y = (np.asarray(latitude, dtype=np.float64) - self._lat0) * METERS_PER_DEGREE
+        return x, y
+
+    def cell(self, latitude, longitude) -> Tuple[int, int]:
+        x, y = self.project(latitude, longitude)
+        return int(np.floor(x / self.CELL_SIZE_M)), int(np.floor(y / self.CELL_SIZE_M))
+
+    def cell_shapes(self) -> Dict[Tuple[int, int], np.ndarray]:
+        # (cell x, cell y) -> indexes in shape_ids of the shapes passing through the cell
+        return {
+            cell: np.unique(np.searchsorted(self.shape_offsets, segments, side="right") - 1)
+            for cell, segments in self._grid.items()
+        }
+
+    def snap(self, shape_id, latitude, longitude, hint: Optional[int] = None) -> Optional[Snap]:
+        bounds = self._shapes.get(str(shape_id))
+        if bounds is None or bounds[1] - bounds[0] < 2:
+            return None
+
+        first, last = bounds[0], bounds[1] - 2
+        x, y = self.project(latitude, longitude)
+
+        # Vehicles move forward, so look around the previous snap first
+        if hint is not None and first <= hint <= last:
+            window = np.arange(max(first, hint - self.WINDOW_BEHIND), min(last, hint + self.WINDOW_AHEAD) + 1)
+            snap = self._closest(window, x, y)
+            if snap.offset <= self.MAX_WINDOW_OFFSET_M:
+                return snap
+
+        cx = int(np.floor(x / self.CELL_SIZE_M))
+        cy = int(np.floor(y / self.CELL_SIZE_M))
+
+        nearby = [
+            self._grid[cell]
+            for cell in ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+            if cell in self._grid
+        ]
+
+        if nearby:
+            candidates = np.concatenate(nearby)
+            candidates = candidates[(candidates >= first) & (candidates <= last)]
+            if len(candidates):
+                return self._closest(candidates, x, y)
+
+        # Far from the shape, scan all of it
+        return self._closest(np.arange(first, last + 1), x, y)
+
+    def snap_sequence(self, shape_id, latitudes, longitudes) -> Optional[np.ndarray]:
+        # Distance along the shape of points visited in order, like a trip's stops
+        bounds = self._shapes.get(str(shape_id))
+        if bounds is None or bounds[1] - bounds[0] < 2:
+            return None
+
+        first, last = bounds[0], bounds[1] - 2
+        xs, ys = self.project(latitudes, longitudes)
+
+        distances = np.empty(len(xs), dtype=np.float32)
+        segment = first
+
+        for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            candidates = np.arange(segment, last + 1)
+            offsets, positions = self._project_segments(candidates, x, y)
+
+            # Take the first pass near the point, not a later one of a looping shape
+            best = int(np.flatnonzero(offsets <= offsets.min() + 20)[0])
+            segment = int(candidates[best])
+            distances[i] = positions[best]
+
+        return distances
+
+    def _closest(self, segments: np.ndarray, x: float, y: float) -> Snap:
+        offsets, positions = self._project_segments(segments, x, y)
+        best = int(np.argmin(offsets))
+        return Snap(segment=int(segments[best]), distance=float(positions[best]), offset=float(offsets[best]))
+
+    def _project_segments(self, segments: np.ndarray, x: float, y: float):
+        x0 = self.x[segments].astype(np.float64)
+        y0 = self.y[segments].astype(np.float64)
+        dx = self.x[segments + 1] - x0
+        dy = self.y[segments + 1] - y0
+
+        length2 = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(length2 > 0, ((x - x0) * dx + (y - y0) * dy) / length2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+
+        offsets = np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+        positions = self.distance[segments] + t * np.sqrt(length2)
+
+        return offsets, positions
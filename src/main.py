@@ -1,30 +1,121 @@
+import os
+import sys
+import queue
+import atexit
+import signal
 import asyncio
 import logging
+import logging.handlers
 
 from .api.views import app
+from .api.shared import shared_feeds_dir
+from .api.publisher import feed_publisher
+from .context import BASE_DIR, gtfs_context
 from uvicorn import Config, Server
+from .websocket.ingest import ingest
+from .websocket.wal import WriteAheadLog
 from .websocket.traccar_client import WsTraccarClient
 
 logger = logging.getLogger(__name__)
 
-logging.basicConfig(
-    encoding="utf-8",
-    datefmt="%H:%M:%S",
-    level=logging.INFO,
-    format="%(levelname)s:     %(message)s",
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
+# Records are only queued on the event loop, a background thread formats and writes them
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+log_formatter = logging.Formatter("%(levelname)s:     %(message)s", datefmt="%H:%M:%S")
+log_handlers = [
+    logging.FileHandler("debug.log", encoding="utf-8"),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# The queue handler only merges the arguments into the message, the listener's handlers do the formatting
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+async def serve_workers(workers: int) -> None:
+    # uvicorn supervises its own worker processes, they only read the shared feeds
+    directory = shared_feeds_dir()
+
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "src.api.worker:app",
+        "--host", "0.0.0.0", "--port", "8000", "--workers", str(workers),
+        cwd=BASE_DIR,
+        env={**os.environ, "shared_feeds_dir": str(directory)}
+    )
+
+    try:
+        code = await process.wait()
+        logger.error(f"uvicorn workers exited with code {code}")
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
 
 async def main() -> None:
+    # Load the schedule before serving, off the event loop
+    await asyncio.to_thread(gtfs_context.load)
+
+    # Vehicles, positions and alerts of the last run, before Traccar sends anything
+    wal_dir = os.getenv("wal_dir")
+    wal_tasks = []
+    if wal_dir:
+        ingest.wal = WriteAheadLog(wal_dir)
+        ingest.restore(await asyncio.to_thread(ingest.wal.load))
+        wal_tasks.append(asyncio.create_task(ingest.wal.run()))
+
     wsc = WsTraccarClient()
-    
-    config = Config(app, host="0.0.0.0", port=8000)
-    server = Server(config)
+    workers = int(os.getenv("workers") or 1)
 
     wsc_task = asyncio.create_task(wsc.get_messages())
-    api_task = asyncio.create_task(server.serve())
+    ingest_task = asyncio.create_task(ingest.run())
+    gtfs_task = asyncio.create_task(gtfs_context.watch())
+
+    if workers > 1:
+        # This process only builds the feeds, the workers serve them from shared memory
+        logger.info(f"Serving feeds with {workers} workers")
+
+        # Metrics, stats, admin and the feed streams live in this process, served on their own port
+        producer_port = int(os.getenv("producer_port") or 8001)
+        producer_server = Server(Config(app, host="0.0.0.0", port=producer_port))
+        logger.info(f"Serving metrics, stats, admin and streams on port {producer_port}")
+
+        # A signal lets the producer's server shut down cleanly, the rest is stopped once it's done
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: setattr(producer_server, "should_exit", True))
+
+        publish_task = asyncio.create_task(feed_publisher.run(shared_feeds_dir()))
+        api_task = asyncio.create_task(serve_workers(workers))
+        producer_task = asyncio.create_task(producer_server.serve())
+
+        tasks = [wsc_task, ingest_task, publish_task, api_task, producer_task, gtfs_task, *wal_tasks]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Stopping serve_workers also stops the workers
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        logger.info("Producer stopped.")
+
+        # Anything but the producer's server finishing is a failure
+        for task in done:
+            task.result()
+
+    else:
+        config = Config(app, host="0.0.0.0", port=8000)
+        server = Server(config)
+
+        api_task = asyncio.create_task(server.serve())
+        # Also drives the WebSocket feed streams
+        publish_task = asyncio.create_task(feed_publisher.run())
 
-    await asyncio.gather(wsc_task, api_task)
\ No newline at end of file
+        await asyncio.gather(wsc_task, ingest_task, api_task, publish_task, gtfs_task, *wal_tasks)
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Minimal Prometheus text exposition. Updates are a dict lookup and an addition,
+# cheap enough for the ingest and feed building hot paths.
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LAG_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}", *self.samples()])
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        # Counters without labels start at 0, not missing
+        values = self._values or ({(): 0} if not self.labels else {})
+        return [f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}" for labels, value in values.items()]
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+        # Read when scraped, for values owned by someone else
+        self._collect = collect
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+    def value(self, *labels) -> Optional[float]:
+        if self._collect is not None:
+            return self._collect()
+
+        return self._values.get(labels)
+
+    def samples(self) -> List[str]:
+        if self._collect is not None:
+            return [f"{self.name} {_format_value(self._collect())}"]
+
+        return [f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}" for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket, the last one is +Inf], sum
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry: Registry = Registry()
+
+INGEST_ITEMS = registry.counter("gtfsrt_ingest_items_total", "Devices, events and positions received from Traccar", ["type"])
+INGEST_COALESCED = registry.counter("gtfsrt_ingest_coalesced_total", "Positions superseded by a newer one of the same device in the same batch")
+INGEST_LAG = registry.histogram("gtfsrt_ingest_lag_seconds", "Seconds between a position's fixTime and its ingestion", buckets=LAG_BUCKETS)
+
+TRIP_MAPPER_CACHE = registry.counter("gtfsrt_trip_mapper_cache_total", "TripMapper cache lookups and evictions", ["result"])
+
+FEED_BUILD_SECONDS = registry.histogram("gtfsrt_feed_build_seconds", "Time to build a feed", ["feed"])
+FEED_SERIALIZE_SECONDS = registry.histogram("gtfsrt_feed_serialize_seconds", "Time to serialize and compress a feed", ["feed"])
+FEED_ENTITIES = registry.gauge("gtfsrt_feed_entities", "Entities in the last built feed", ["feed"])
+FEED_TIMESTAMP = registry.gauge("gtfsrt_feed_timestamp_seconds", "Header timestamp of the last built feed", ["feed"])
+
+TRACCAR_CONNECTED = registry.gauge("gtfsrt_traccar_connected", "1 while the Traccar WebSocket is connected")
+TRACCAR_RECONNECTS = registry.counter("gtfsrt_traccar_reconnects_total", "Traccar WebSocket connection attempts after the first one")
+TRACCAR_LAST_MESSAGE = registry.gauge("gtfsrt_traccar_last_message_timestamp_seconds", "UNIX time of the last Traccar WebSocket frame")
+TRACCAR_CONNECTED.set(0)
@@ -0,0 +1,124 @@
+import json
+import logging
+
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, FrozenSet, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Geofences of the original deployment, used when nothing else maps them
+DEFAULT_ROUTES: Dict[int, str] = {
+    1: "55",
+    2: "50",
+    3: "62",
+    4: "53",
+    5: "54",
+    6: "60",
+    7: "51",
+    8: "52",
+    9: "56",
+    10: "57",
+    11: "58",
+    12: "59",
+    59: "61",
+    60: "64",
+    61: "63",
+}
+
+def normalize_route_id(value: Any) -> Optional[str]:
+    # Route ids typed in routes.json or Traccar, " 55 " and 55 are route "55", None when blank
+    if value is None:
+        return None
+
+    route_id = str(value).strip()
+    if not route_id:
+        return None
+
+    # The schedule's route ids are numbers, "055" is the same route
+    return str(int(route_id)) if route_id.isdigit() else route_id
+
+
+def _normalize_routes(routes: Dict[int, Any], source: str) -> Dict[int, str]:
+    normalized = {}
+
+    for geofence_id, value in routes.items():
+        route_id = normalize_route_id(value)
+        if route_id is None:
+            logger.warning(f"Geofence {geofence_id} has no route_id in {source}, ignoring it")
+            continue
+
+        normalized[geofence_id] = route_id
+
+    return normalized
+
+
+def load_routes(path: Optional[Path]) -> Optional[Dict[int, str]]:
+    # JSON object of geofence id -> route_id, None when there's no file
+    if path is None or not path.exists():
+        return None
+
+    try:
+        routes = _normalize_routes({int(geofence_id): route_id for geofence_id, route_id in json.loads(path.read_text()).items()}, str(path))
+    except (OSError, ValueError, AttributeError) as e:
+        logger.error(f"Could not read the geofence routes from {path}: {e}")
+        return None
+
+    logger.info(f"Loaded {len(routes)} geofence routes from {path}")
+
+    return routes
+
+
+def geofence_routes(geofences: Iterable[Dict[str, Any]], attribute: str) -> Dict[int, str]:
+    # Traccar geofences carrying their route_id as an attribute
+    routes = {}
+
+    for geofence in geofences:
+        route_id = (geofence.get("attributes") or {}).get(attribute)
+        if route_id is not None and geofence.get("id") is not None:
+            routes[int(geofence["id"])] = route_id
+
+    return _normalize_routes(routes, "Traccar")
+
+
+class RouteInference:
+    # Route of a vehicle outside any mapped geofence, voted by the shapes near its last positions
+    WINDOW = 8
+    MIN_VOTES = 6
+
+    def __init__(self) -> None:
+        # device_id -> routes near each of the last positions
+        self._recent: Dict[Any, Deque[FrozenSet[str]]] = {}
+
+    def observe(self, device_id, routes: FrozenSet[str]) -> None:
+        recent = self._recent.get(device_id)
+        if recent is None:
+            recent = self._recent[device_id] = deque(maxlen=self.WINDOW)
+
+        recent.append(routes)
+
+    def route(self, device_id) -> Optional[str]:
+        # The only route near enough of the last positions, None while it's ambiguous
+        recent = self._recent.get(device_id)
+        if not recent:
+            return None
+
+        votes: Dict[str, int] = {}
+        for routes in recent:
+            for route_id in routes:
+                votes[route_id] = votes.get(route_id, 0) + 1
+
+        if not votes:
+            return None
+
+        # Routes sharing the street all get the votes, only a clear winner counts
+        best = max(votes.values())
+        winners = [route_id for route_id, count in votes.items() if count == best]
+
+        return winners[0] if best >= self.MIN_VOTES and len(winners) == 1 else None
+
+    def forget(self, device_id) -> None:
+        self._recent.pop(device_id, None)
+
+    def clear(self) -> None:
+        self._recent.clear()
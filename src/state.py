@@ -0,0 +1,132 @@
+import math
+import numpy as np
+
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    # Traccar times are ISO 8601, e.g. "2025-05-15T14:03:21.000+00:00"
+    if not value:
+        return None
+
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class PositionHistory:
+    # Fixed-size ring buffer of the latest positions of a vehicle
+    __slots__ = ("_rows", "_next", "_count")
+
+    SIZE = 16
+    # Columns of every row
+    TIME, LATITUDE, LONGITUDE, SPEED = range(4)
+
+    def __init__(self) -> None:
+        self._rows = np.zeros((self.SIZE, 4), dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, fix_time: float, latitude: float, longitude: float, speed: Optional[float]) -> None:
+        self._rows[self._next] = (fix_time, latitude, longitude, np.nan if speed is None else speed)
+        self._next = (self._next + 1) % self.SIZE
+        self._count = min(self._count + 1, self.SIZE)
+
+    def recent(self) -> np.ndarray:
+        # Oldest first
+        if self._count < self.SIZE:
+            return self._rows[:self._count]
+
+        return np.roll(self._rows, -self._next, axis=0)
+
+    def smoothed_speed(self, samples: int = 5) -> Optional[float]:
+        # Mean of the last speeds, so a red light doesn't read as a stopped bus
+        speeds = self.recent()[-samples:, self.SPEED]
+        speeds = speeds[~np.isnan(speeds)]
+
+        return float(speeds.mean()) if len(speeds) else None
+
+    def heading(self, min_distance_m: float = 20) -> Optional[float]:
+        # Bearing in degrees from the oldest to the newest position, if the vehicle moved enough
+        rows = self.recent()
+        if len(rows) < 2:
+            return None
+
+        lat1, lon1 = np.radians(rows[0, [self.LATITUDE, self.LONGITUDE]])
+        lat2, lon2 = np.radians(rows[-1, [self.LATITUDE, self.LONGITUDE]])
+
+        x = math.sin(lon2 - lon1) * math.cos(lat2)
+        y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+
+        # Equirectangular distance is plenty to tell a parked vehicle apart
+        distance = 6371008.8 * math.hypot((lon2 - lon1) * math.cos((lat1 + lat2) / 2), lat2 - lat1)
+        if distance < min_distance_m:
+            return None
+
+        return (math.degrees(math.atan2(x, y)) + 360) % 360
+
+
+class VehicleEvent:
+    __slots__ = ("id", "type", "alarm", "event_time", "geofence_id")
+
+    def __init__(self, event: Dict[str, Any]) -> None:
+        self.id = event.get("id")
+        self.type = event.get("type")
+        self.alarm = event.get("attributes", {}).get("alarm", "")
+        self.event_time = event.get("eventTime")
+        self.geofence_id = event.get("geofenceId")
+
+
+class VehicleState:
+    # Only the fields the feeds use are kept from Traccar's device, position and event
+    __slots__ = (
+        "id", "name", "route_id", "geofence_id",
+        "latitude", "longitude", "course", "speed",
+        "device_time", "fix_time", "position_id",
+        "event", "history"
+    )
+
+    def __init__(self, device_id, name: str, route_id: str) -> None:
+        self.id = device_id
+        self.name = name
+        self.route_id = route_id
+        # Traccar currentGeofence, the route comes from it when it's mapped
+        self.geofence_id = None
+
+        self.latitude: float = 0.0
+        self.longitude: float = 0.0
+        self.course: float = 0.0
+        # m/s, None when Traccar didn't send it
+        self.speed: Optional[float] = None
+        # Raw deviceTime string, None until the first position
+        self.device_time: Optional[str] = None
+        # fixTime as a UNIX timestamp
+        self.fix_time: Optional[float] = None
+        self.position_id = None
+
+        self.event: Optional[VehicleEvent] = None
+        self.history = PositionHistory()
+
+    @property
+    def has_position(self) -> bool:
+        return self.device_time is not None
+
+    def update_position(self, position: Dict[str, Any]) -> bool:
+        fix_time = parse_time(position.get("fixTime") or position["deviceTime"])
+
+        # A late frame or the REST snapshot can be older than what we already have
+        if self.fix_time is not None and fix_time is not None and fix_time < self.fix_time:
+            return False
+
+        self.latitude = float(position["latitude"])
+        self.longitude = float(position["longitude"])
+        self.course = float(position.get("course", 0.0))
+        self.speed = float(position["speed"]) if position.get("speed") is not None else None
+        self.device_time = position["deviceTime"]
+        self.fix_time = fix_time
+        self.position_id = position.get("id")
+
+        self.history.append(self.fix_time, self.latitude, self.longitude, self.speed)
+
+        return True
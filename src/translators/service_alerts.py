@@ -1,57 +1,90 @@
 import logging
-from datetime import datetime, timedelta
+from time import time
+from typing import Any, Dict, Optional, Tuple
 
 from src.context import context
-from .trip_mapper import TripMapper
 from src.factories.feed_message import FeedMessage
 from src.factories.service_alert import ServiceAlert
+from src.metrics import FEED_BUILD_SECONDS, FEED_ENTITIES, FEED_TIMESTAMP
 
 logger = logging.getLogger(__name__)
 
 class ServiceAlerts:
-    _known_ids = set()
+    # Entity of every alert in the feed, as of the last build
+    _entities: Dict[Any, Any] = {}
+    # Alert id -> (end, entity), an alert's entity only changes when it's closed
+    _built: Dict[str, Tuple[Optional[float], Any]] = {}
+    _last_feed = None
+    # Alert store version the last feed was built from
+    _last_version = None
 
     @staticmethod
     def make():
-        updated = 0
-        created = 0
+        # Alerts only change with events or when they expire, the feed is kept until then
+        alerts = context.alerts
+        alerts.expire(time())
 
-        service_alerts = []
+        if ServiceAlerts._last_feed is not None and ServiceAlerts._last_version == alerts.version:
+            return ServiceAlerts._last_feed
 
-        for data in context.data.values():
-            if "position" in data:
-                route_id = data["route_id"]
-                event = data.get("event", {})
+        return ServiceAlerts.refresh()
 
-                event_type = event.get("type")
-                attributes = event.get("attributes", {})
-                alarm = attributes.get("alarm", "")
-
-                is_valid_event = (
-                    event_type == "geofenceExited" or
-                    (event_type == "alarm" and alarm == "geofenceExited")
-                )
+    @staticmethod
+    def entities() -> Dict[Any, Any]:
+        # (device_id, route_id) -> entity, as of the last build
+        return ServiceAlerts._entities
 
-                if not is_valid_event:
-                    continue
+    @staticmethod
+    def refresh():
+        start_time = time()
+        updated = 0
+        created = 0
 
-                event_time = event["eventTime"].replace("Z", "+00:00")
+        version = context.alerts.version
+        entities = {}
+        built = {}
 
-                vehicle_name = data["name"]
+        for alert in context.alerts.alerts():
+            # Read once, the alert may be closed meanwhile on the event loop
+            end = alert.end
+            cached = ServiceAlerts._built.get(alert.id)
+            entity = cached[1] if cached is not None and cached[0] == end else None
 
+            if entity is None:
                 params = {
-                    "entity_id": f"D{event['id']}",
-                    "route_id": route_id,
-                    "event_time": event_time,
+                    "entity_id": alert.id,
+                    "route_id": alert.route_id,
+                    "start_time": alert.start,
+                    "end_time": end,
                     "effect": "DETOUR",
                     "language": "es",
                     "header_text": "Alerta de Desvío",
-                    "description_text": f"Vehículo {vehicle_name}, salió de la geocerca con la ruta {route_id}"
+                    "description_text": f"Vehículo {alert.vehicle_name}, salió de la geocerca con la ruta {alert.route_id}"
                 }
 
-                service_alert = ServiceAlert.create(**params)
-                service_alerts.append(service_alert)
+                entity = ServiceAlert.create(**params)
+
+                if cached is not None:
+                    updated += 1
+                else:
+                    created += 1
+
+            entities[(alert.device_id, alert.route_id)] = entity
+            built[alert.id] = (end, entity)
+
+        service_alerts = list(entities.values())
+
+        feed = FeedMessage.create(entities=service_alerts)
+
+        ServiceAlerts._entities = entities
+        ServiceAlerts._built = built
+        ServiceAlerts._last_feed = feed
+        ServiceAlerts._last_version = version
+
+        FEED_BUILD_SECONDS.observe(time() - start_time, "service_alerts")
+        FEED_ENTITIES.set(len(service_alerts), "service_alerts")
+        FEED_TIMESTAMP.set(feed.header.timestamp, "service_alerts")
 
         logger.info(f"ServiceAlerts feed created. Total: {len(service_alerts)}, New: {created}, Updated: {updated}")
-        
-        return FeedMessage.create(entities=service_alerts)
+
+        return feed
@@ -1,101 +1,234 @@
 import os
-import pytz
-import pandas as pd
 import logging
-from functools import lru_cache
-from typing import Dict, List, Tuple, Optional
+import numpy as np
+from time import monotonic
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Sequence, Tuple, Optional
 
-from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from src.context import gtfs_context
-
-load_dotenv()
+from datetime import date, datetime, timedelta
+from src.context import TIMEZONE, gtfs_context
+from src.metrics import TRIP_MAPPER_CACHE, registry
 
 logger = logging.getLogger(__name__)
 
+class TtlLruCache:
+    # Bounded cache, the least recently used entry goes first when full and
+    # entries expire after ttl seconds. Every operation is O(1).
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires, value), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            TRIP_MAPPER_CACHE.inc("miss")
+            return None
+
+        if entry[0] <= monotonic():
+            del self._entries[key]
+            self.misses += 1
+            self.expirations += 1
+            TRIP_MAPPER_CACHE.inc("miss")
+            TRIP_MAPPER_CACHE.inc("expiration")
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        TRIP_MAPPER_CACHE.inc("hit")
+
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.max_size:
+            # Expired entries nobody asks for again leave this way too
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            TRIP_MAPPER_CACHE.inc("eviction")
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class TripAssignment:
+    __slots__ = ("route_id", "trip_id", "stops", "service_date", "arrival", "device_time", "done")
+
+    def __init__(self, route_id, trip_id: str, stops: Sequence[Dict], service_date: date, arrival: np.ndarray, device_time: str) -> None:
+        self.route_id = route_id
+        self.trip_id = trip_id
+        self.stops = stops
+        # Arrival times are seconds since this day's midnight, past 24:00 for trips after it
+        self.service_date = service_date
+        self.arrival = arrival
+        # Position that made or last confirmed the assignment
+        self.device_time = device_time
+        # Trip ended or the vehicle left its schedule, re-matched on the next position
+        self.done = False
+
+    def seconds(self, dt: datetime) -> int:
+        return (dt.date() - self.service_date).days * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+
 class TripMapper:
-    # Cache for storing previously calculated trip mappings
-    _cache: Dict[str, Tuple[str, List[Dict]]] = {}
-    # Cache expiration time (in seconds)
-    _cache_expiry: Dict[str, datetime] = {}
-    # Cache lifetime (10 minutes)
-    _cache_lifetime = timedelta(minutes=10)
+    # (route_id, date, minute) -> (trip_id, stops) of previously calculated mappings
+    _cache = TtlLruCache(
+        max_size=int(os.getenv("trip_cache_size") or 10000),
+        ttl=float(os.getenv("trip_cache_ttl") or 600)
+    )
+
+    # device_id -> trip the vehicle is running, kept while it progresses along it
+    _assignments: Dict[Any, TripAssignment] = {}
+    # Re-match when a position is this far before the first departure or after the last arrival
+    EARLY_MARGIN_S = 15 * 60
+    LATE_MARGIN_S = 30 * 60
+    # or this far from the schedule at the stop the vehicle is at
+    MAX_DEVIATION_S = 20 * 60
+    # Set by clear_cache, see _clear_if_requested
+    _clear_requested = False
 
     @staticmethod
-    def map(route_id, device_time):
-        dt = datetime.fromisoformat(device_time.replace("Z", "+00:00"))
-        
-        timezone = pytz.timezone(os.getenv("timezone"))
-        dt = dt.astimezone(timezone)
-
-        date = dt.strftime("%Y%m%d")
-        time = dt.strftime("%H:%M:%S")
-        
-        # Create a cache key based on route_id and approximate time (rounded to the nearest minute)
-        rounded_time = dt.replace(second=0, microsecond=0)
-        cache_key = f"{route_id}_{date}_{rounded_time.strftime('%H:%M')}"
-        
-        # Check if we have a valid cached result
-        now = datetime.now()
-        if cache_key in TripMapper._cache and TripMapper._cache_expiry.get(cache_key, datetime.min) > now:
-            return TripMapper._cache[cache_key]
-            
-        # If not in cache or expired, calculate the mapping
-        result = TripMapper._calculate_mapping(route_id, dt, date, time)
-        
+    def assign(device_id, route_id, device_time) -> Optional[Tuple[str, Sequence[Dict], date]]:
+        # (trip_id, stops, service date of the trip) the vehicle is running
+        TripMapper._clear_if_requested()
+
+        dt = TripMapper._local_time(device_time)
+        assignment = TripMapper._assignments.get(device_id)
+
+        if assignment is not None and assignment.route_id == route_id and not (assignment.done and assignment.device_time != device_time):
+            seconds = assignment.seconds(dt)
+            if assignment.arrival[0] - TripMapper.EARLY_MARGIN_S <= seconds <= assignment.arrival[-1] + TripMapper.LATE_MARGIN_S:
+                assignment.device_time = device_time
+                return assignment.trip_id, assignment.stops, assignment.service_date
+
+        result = TripMapper.map(route_id, device_time)
+        if result is None:
+            TripMapper._assignments.pop(device_id, None)
+            return None
+
+        trip_id, stops, service_date = result
+        trip_arrays = gtfs_context.trip_arrays(trip_id)
+
+        if trip_arrays is None or len(trip_arrays.arrival) == 0:
+            TripMapper._assignments.pop(device_id, None)
+            return trip_id, stops, service_date
+
+        if assignment is None or assignment.trip_id != trip_id:
+            logger.debug(f"Device {device_id} assigned to trip {trip_id} of route {route_id}")
+
+        TripMapper._assignments[device_id] = TripAssignment(route_id, trip_id, stops, service_date, trip_arrays.arrival, device_time)
+
+        return trip_id, stops, service_date
+
+    @staticmethod
+    def progress(device_id, trip_id, stop_index: int, status: str) -> None:
+        # Called with where the vehicle is along its trip, to let go of it at the end or when far off schedule
+        assignment = TripMapper._assignments.get(device_id)
+        if assignment is None or assignment.trip_id != trip_id or assignment.done:
+            return
+
+        last_stop = len(assignment.arrival) - 1
+        deviation = assignment.seconds(TripMapper._local_time(assignment.device_time)) - int(assignment.arrival[stop_index])
+
+        if stop_index == last_stop and status == "STOPPED_AT":
+            assignment.done = True
+        elif abs(deviation) > TripMapper.MAX_DEVIATION_S:
+            logger.debug(f"Device {device_id} is {deviation}s off trip {trip_id}, re-matching")
+            assignment.done = True
+
+    @staticmethod
+    def map(route_id, device_time) -> Optional[Tuple[str, Sequence[Dict], date]]:
+        # (trip_id, stops, service date of the trip) of the trip departing closest to the device time
+        TripMapper._clear_if_requested()
+
+        dt = TripMapper._local_time(device_time)
+
+        # Positions within the same minute share the mapping
+        cache_key = (route_id, dt.date(), dt.hour * 60 + dt.minute)
+
+        result = TripMapper._cache.get(cache_key)
+        if result is not None:
+            return result
+
+        result = TripMapper._calculate_mapping(route_id, dt)
+
         # Cache the result if valid
         if result:
-            TripMapper._cache[cache_key] = result
-            TripMapper._cache_expiry[cache_key] = now + TripMapper._cache_lifetime
-            
-            # Clean old cache entries
-            expired_keys = [k for k, v in TripMapper._cache_expiry.items() if v <= now]
-            for k in expired_keys:
-                TripMapper._cache.pop(k, None)
-                TripMapper._cache_expiry.pop(k, None)
-        
+            TripMapper._cache.put(cache_key, result)
+
         return result
-    
-    @staticmethod
-    def _calculate_mapping(route_id, dt, date, time) -> Optional[Tuple[str, List[Dict]]]:
-        weekday = dt.strftime("%A").lower()
 
-        calendar = gtfs_context.calendar
-        calendar = calendar[(calendar[weekday] == 1)]
-        calendar = calendar[(calendar["start_date"] <= int(date)) & (calendar["end_date"] >= int(date))]
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        return {**TripMapper._cache.stats(), "assignments": len(TripMapper._assignments)}
 
-        active_services = calendar["service_id"].unique()
+    @staticmethod
+    def clear_cache():
+        # Called on the event loop while the builder thread may be mid-lookup, so the builder
+        # clears both itself on its next lookup
+        TripMapper._clear_requested = True
 
-        trips = gtfs_context.trips
-        today_trips = trips[(trips["route_id"] == int(route_id)) & trips["service_id"].isin(active_services)]
+    @staticmethod
+    def _clear_if_requested() -> None:
+        if TripMapper._clear_requested:
+            TripMapper._clear_requested = False
+            TripMapper._cache.clear()
+            TripMapper._assignments.clear()
 
-        merged = pd.merge(today_trips, gtfs_context.stop_times, on='trip_id')
-        first_stops = merged.sort_values(["trip_id", "stop_sequence"]).groupby("trip_id").first().reset_index()
+    @staticmethod
+    def _local_time(device_time: str) -> datetime:
+        dt = datetime.fromisoformat(device_time.replace("Z", "+00:00"))
+        return dt.astimezone(TIMEZONE)
 
-        if first_stops.empty:
+    @staticmethod
+    def _calculate_mapping(route_id, dt) -> Optional[Tuple[str, Sequence[Dict], date]]:
+        today = dt.date()
+        yesterday = today - timedelta(days=1)
+        seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+
+        # Trips of the previous service day run past midnight with times after 24:00:00
+        candidates = []
+        for service_date, service_seconds in ((today, seconds), (yesterday, seconds + 86400)):
+            # Binary search over the precomputed first departures of the route
+            nearest = gtfs_context.nearest_departure(route_id, gtfs_context.active_services(service_date), service_seconds)
+            if nearest is not None:
+                candidates.append((*nearest, service_date))
+
+        if not candidates:
             return None
 
-        first_stops["time_diff"] = first_stops["departure_time"].apply(
-            lambda t: abs((datetime.strptime(t, "%H:%M:%S") - datetime.strptime(time, "%H:%M:%S")).total_seconds())
-        )
-
-        best_match = first_stops.sort_values("time_diff").iloc[0]
-        trip_id = best_match["trip_id"]
-
-        # Get all stops for this trip
-        trip_stops = merged[merged["trip_id"] == trip_id].sort_values("stop_sequence")
+        _, trip_id, service_date = min(candidates, key=lambda candidate: candidate[0])
 
-        stops_df = pd.merge(trip_stops, gtfs_context.stops, on="stop_id")
+        return trip_id, gtfs_context.trip_stops(trip_id), service_date
 
-        stops = []
-        
-        for _, row in stops_df.iterrows():
-            stops.append({
-                "stop_sequence": int(row["stop_sequence"]),
-                "stop_id": row["stop_id"],
-                "stop_lat": row["stop_lat"],
-                "stop_lon": row["stop_lon"],
-                "arrival_time": row["arrival_time"]
-            })
+# Cached and assigned trips may not exist in a reloaded schedule
+gtfs_context.add_listener(TripMapper.clear_cache)
 
-        return trip_id, stops
+registry.gauge("gtfsrt_trip_mapper_cache_size", "Trip mappings in the TripMapper cache", collect=lambda: len(TripMapper._cache))
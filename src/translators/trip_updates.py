@@ -1,85 +1,172 @@
 import logging
 from time import time
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Set
 from datetime import datetime, timedelta
 
-from src.context import context
+from src.context import context, gtfs_context
+from src.state import VehicleState
 from .trip_mapper import TripMapper
+from .vehicle_progress import VehicleProgress
 from src.factories.feed_message import FeedMessage
 from src.factories.trip_update import TripUpdate
+from src.metrics import FEED_BUILD_SECONDS, FEED_ENTITIES, FEED_TIMESTAMP
 
 logger = logging.getLogger(__name__)
 
 class TripUpdates:
     _known_ids = set()
+    # Last built entity of every device in the feed
+    _entities: Dict[Any, Any] = {}
+    # Inputs of every device's entity, so delays can be recomputed without re-matching the trip
+    _vehicles: Dict[Any, Dict[str, Any]] = {}
+    _last_recompute = datetime.min
+    # Same as the publisher's refresh interval, a tick without changes recomputes every vehicle
+    _recompute_interval = timedelta(seconds=30)
     _last_feed = None
-    _last_feed_time = datetime.min
-    # Cache the feed for 10 seconds
-    _cache_lifetime = timedelta(seconds=10)
 
     @staticmethod
-    def make():
+    def entities() -> Dict[Any, Any]:
+        # device_id -> entity, as of the last build
+        return TripUpdates._entities
+
+    @staticmethod
+    def invalidate():
+        # After a GTFS reload the next build recomputes every vehicle, not only the dirty ones
+        TripUpdates._last_recompute = datetime.min
+
+    @staticmethod
+    def refresh():
+        # Brings the feed up to date, called by the publisher's builder thread
         now = datetime.now()
-        
-        # Return cached feed if it's still fresh
-        if TripUpdates._last_feed and TripUpdates._last_feed_time + TripUpdates._cache_lifetime > now:
-            logger.info("Using cached trip updates feed")
+
+        # Only devices that reported since the last build need a new entity
+        dirty = context.take_dirty("trip_updates")
+        # Delays depend on the time, vehicles that stopped reporting are recomputed every so often
+        recompute = now - TripUpdates._last_recompute >= TripUpdates._recompute_interval
+
+        if TripUpdates._last_feed and not dirty and not recompute:
             return TripUpdates._last_feed
             
         start_time = time()
         updated = 0
         created = 0
 
-        # Pre-allocate list
-        estimated_size = len(context.data)
-        trip_updates: List[Any] = []
-        trip_updates.reserve(estimated_size) if hasattr(list, 'reserve') else None
+        vehicles: List[Dict[str, Any]] = []
+        failed = set()
 
-        for data in context.data.values():
-            if "position" not in data or "route_id" not in data:
-                continue
-                
-            entity_id = data["id"]
-            position = data["position"]
-            route_id = data["route_id"]
-            device_time = position["deviceTime"]
-
-            # Get trip information
-            trip_data = TripMapper.map(route_id, device_time)
-            if trip_data is None:
-                continue
+        for device_id in dirty:
+            data = context.data.get(device_id)
 
-            trip_id, stops = trip_data
+            # A device that can't be built keeps its previous entity, the rest of the fleet goes on
+            try:
+                vehicle = TripUpdates._prepare(data) if data is not None else None
+            except Exception as e:
+                logger.error(f"Failed to prepare the trip update of device {device_id}: {e}")
+                failed.add(device_id)
+                continue
 
-            speed_kmh = position.get("speed", 25) * 3.6  # m/s a km/h
+            if vehicle is None:
+                TripUpdates._vehicles.pop(device_id, None)
+                TripUpdates._entities.pop(device_id, None)
+                continue
 
-            params = {
-                "entity_id": entity_id,
-                "trip_id": trip_id,
-                "stops": stops,
-                "vehicle_id": data["name"],
-                "latitude": position["latitude"],
-                "longitude": position["longitude"],
-                "speed_kmh": speed_kmh,
-            }
+            TripUpdates._vehicles[device_id] = vehicle
+            vehicles.append(vehicle)
 
-            if entity_id in TripUpdates._known_ids:
+            if device_id in TripUpdates._known_ids:
                 updated += 1
             else:
                 created += 1
-                TripUpdates._known_ids.add(entity_id)
+                TripUpdates._known_ids.add(device_id)
+
+        if recompute:
+            vehicles = list(TripUpdates._vehicles.values())
+            TripUpdates._last_recompute = now
 
-            trip_update = TripUpdate.create(**params)
-            trip_updates.append(trip_update)
+        failed.update(TripUpdates._create(vehicles))
+
+        if failed:
+            context.return_dirty("trip_updates", failed)
+
+        trip_updates = list(TripUpdates._entities.values())
 
         # Create feed
         feed = FeedMessage.create(entities=trip_updates)
         
         # Cache the feed
         TripUpdates._last_feed = feed
-        TripUpdates._last_feed_time = now
         
         end_time = time()
+
+        FEED_BUILD_SECONDS.observe(end_time - start_time, "trip_updates")
+        FEED_ENTITIES.set(len(trip_updates), "trip_updates")
+        FEED_TIMESTAMP.set(feed.header.timestamp, "trip_updates")
+
         logger.info(f"TripUpdates feed created in {(end_time - start_time):.3f}s, Total: {len(trip_updates)}, New: {created}, Updated: {updated}")
         
         return feed
+
+    @staticmethod
+    def _create(vehicles: List[Dict[str, Any]]) -> Set[Any]:
+        # Distances and delays of all the vehicles are computed in one batch, returns the devices that failed
+        failed = set()
+
+        try:
+            built = list(zip(vehicles, TripUpdate.create_batch(vehicles)))
+        except Exception:
+            # One bad vehicle fails the whole batch, build them one by one to leave it out
+            built = []
+            for vehicle in vehicles:
+                try:
+                    built.append((vehicle, TripUpdate.create_batch([vehicle])[0]))
+                except Exception as e:
+                    logger.error(f"Failed to build the trip update of device {vehicle['entity_id']}: {e}")
+                    failed.add(vehicle["entity_id"])
+
+        for vehicle, trip_update in built:
+            TripUpdates._entities[vehicle["entity_id"]] = trip_update
+
+        return failed
+
+    @staticmethod
+    def _prepare(data: VehicleState) -> Optional[Dict[str, Any]]:
+        if not data.has_position or data.route_id is None:
+            return None
+
+        entity_id = data.id
+        route_id = data.route_id
+
+        # Get trip information
+        trip_data = TripMapper.assign(entity_id, route_id, data.device_time)
+        if trip_data is None:
+            return None
+
+        trip_id, _, service_date = trip_data
+
+        trip_arrays = gtfs_context.trip_arrays(trip_id)
+        if trip_arrays is None:
+            return None
+
+        # Stops the vehicle already passed get no prediction
+        progress = VehicleProgress.locate(entity_id, trip_id, data.latitude, data.longitude)
+        if progress is not None:
+            TripMapper.progress(entity_id, trip_id, progress.stop_index, progress.status)
+            trip_arrays = trip_arrays._make(column[progress.stop_index:] for column in trip_arrays)
+
+        # Averaged over the last positions, a single stop would zero the ETAs
+        speed = data.history.smoothed_speed()
+        speed_kmh = (speed if speed is not None else 25) * 3.6  # m/s a km/h
+
+        return {
+            "entity_id": entity_id,
+            "trip_id": trip_id,
+            "vehicle_id": data.name,
+            "latitude": data.latitude,
+            "longitude": data.longitude,
+            "speed_kmh": speed_kmh,
+            # Arrivals are seconds since this day's midnight, past 24:00 for trips after it
+            "service_date": service_date,
+            **trip_arrays._asdict()
+        }
+
+gtfs_context.add_listener(TripUpdates.invalidate)
\ No newline at end of file
@@ -1,93 +1,133 @@
 import logging
 from time import time
-from typing import Dict, Any, List, Optional
-from datetime import datetime, timedelta
+from typing import Dict, Any
 
 from src.context import context
+from src.state import VehicleState
 from .trip_mapper import TripMapper
+from .vehicle_progress import VehicleProgress
 from src.factories.feed_message import FeedMessage
 from src.factories.vehicle_position import VehiclePosition
+from src.metrics import FEED_BUILD_SECONDS, FEED_ENTITIES, FEED_TIMESTAMP
 
 logger = logging.getLogger(__name__)
 
 class VehiclePositions:
     _known_ids = set()
+    # Last built entity of every device in the feed
+    _entities: Dict[Any, Any] = {}
     _last_feed = None
-    _last_feed_time = datetime.min
-    # Cache the feed for 10 seconds
-    _cache_lifetime = timedelta(seconds=10)
+    # Speed above which a vehicle is moving, in the units of Traccar's speed
+    MOVING_SPEED = 1.0
 
     @staticmethod
-    def make():
-        now = datetime.now()
-        
-        # Return cached feed if it's still fresh
-        if VehiclePositions._last_feed and VehiclePositions._last_feed_time + VehiclePositions._cache_lifetime > now:
-            logger.info("Using cached vehicle positions feed")
+    def entities() -> Dict[Any, Any]:
+        # device_id -> entity, as of the last build
+        return VehiclePositions._entities
+
+    @staticmethod
+    def refresh():
+        # Brings the feed up to date, called by the publisher's builder thread
+        # Only devices that reported since the last build need a new entity
+        dirty = context.take_dirty("vehicle_positions")
+
+        if VehiclePositions._last_feed and not dirty:
             return VehiclePositions._last_feed
         
         start_time = time()
         updated = 0
         created = 0
 
-        # Pre-allocate the list with an estimated size
-        estimated_size = len(context.data)
-        vehicle_positions: List[Any] = []
-        vehicle_positions.reserve(estimated_size) if hasattr(list, 'reserve') else None
-        
-        # Batch process the positions
-        for data in context.data.values():
-            if "position" not in data:
-                continue
-                
-            entity_id = data["id"]
-            position = data.get("position", {})
-            
-            if "route_id" not in data:
-                continue
-                
-            route_id = data["route_id"]
-            device_time = position["deviceTime"]
+        failed = set()
+
+        for device_id in dirty:
+            data = context.data.get(device_id)
 
-            # Get trip information
-            trip_data = TripMapper.map(route_id, device_time)
-            if trip_data is None:
+            # A device that can't be built keeps its previous entity, the rest of the fleet goes on
+            try:
+                vehicle_position = VehiclePositions._build(data) if data is not None else None
+            except Exception as e:
+                logger.error(f"Failed to build the vehicle position of device {device_id}: {e}")
+                failed.add(device_id)
                 continue
 
-            trip_id, stops = trip_data
-
-            # Create vehicle position entity
-            params = {
-                "entity_id": entity_id,
-                "route_id": route_id,
-                "trip_id": trip_id,
-                "stop_id": stops[0]["stop_id"],
-                "vehicle_id": data["name"],
-                "bearing": position["course"],
-                "latitude": position["latitude"],
-                "longitude": position["longitude"],
-                "current_stop_sequence": stops[0]["stop_sequence"]
-            }
+            if vehicle_position is None:
+                VehiclePositions._entities.pop(device_id, None)
+                continue
 
             # Track known IDs
-            if entity_id in VehiclePositions._known_ids:
+            if device_id in VehiclePositions._known_ids:
                 updated += 1
             else:
                 created += 1
-                VehiclePositions._known_ids.add(entity_id)
+                VehiclePositions._known_ids.add(device_id)
 
-            vehicle_position = VehiclePosition.create(**params)
-            vehicle_positions.append(vehicle_position)
+            VehiclePositions._entities[device_id] = vehicle_position
+
+        if failed:
+            context.return_dirty("vehicle_positions", failed)
+
+        vehicle_positions = list(VehiclePositions._entities.values())
         
         # Create feed message
         feed = FeedMessage.create(entities=vehicle_positions)
         
         # Cache the feed
         VehiclePositions._last_feed = feed
-        VehiclePositions._last_feed_time = now
         
         end_time = time()
+
+        FEED_BUILD_SECONDS.observe(end_time - start_time, "vehicle_positions")
+        FEED_ENTITIES.set(len(vehicle_positions), "vehicle_positions")
+        FEED_TIMESTAMP.set(feed.header.timestamp, "vehicle_positions")
+
         logger.info(f"VehiclePositions feed created in {(end_time - start_time):.3f}s, Total: {len(vehicle_positions)}, New: {created}, Updated: {updated}")
 
         return feed
 
+    @staticmethod
+    def _build(data: VehicleState):
+        if not data.has_position or data.route_id is None:
+            return None
+
+        entity_id = data.id
+        route_id = data.route_id
+
+        # Get trip information
+        trip_data = TripMapper.assign(entity_id, route_id, data.device_time)
+        if trip_data is None:
+            return None
+
+        trip_id, stops, _ = trip_data
+
+        # Snap to the trip's shape, without one assume the vehicle is at the first stop
+        progress = VehicleProgress.locate(entity_id, trip_id, data.latitude, data.longitude)
+        stop = stops[progress.stop_index] if progress else stops[0]
+
+        if progress is not None:
+            TripMapper.progress(entity_id, trip_id, progress.stop_index, progress.status)
+
+        # Traccar reports course 0 when the device doesn't know it, a moving vehicle gets
+        # the bearing of its last positions instead
+        bearing = data.course
+        if not bearing and (data.history.smoothed_speed() or 0) > VehiclePositions.MOVING_SPEED:
+            heading = data.history.heading()
+            if heading is not None:
+                bearing = heading
+
+        # Create vehicle position entity
+        params = {
+            "entity_id": entity_id,
+            "route_id": route_id,
+            "trip_id": trip_id,
+            "stop_id": stop["stop_id"],
+            "vehicle_id": data.name,
+            "bearing": bearing,
+            "latitude": data.latitude,
+            "longitude": data.longitude,
+            "current_stop_sequence": stop["stop_sequence"],
+            "current_status": progress.status if progress else "STOPPED_AT"
+        }
+
+        return VehiclePosition.create(**params)
+
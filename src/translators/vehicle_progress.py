@@ -0,0 +1,77 @@
+import numpy as np
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from src.context import gtfs_context
+
+class Progress(NamedTuple):
+    # Index, within the trip's stops, of the stop the vehicle is at or heading to
+    stop_index: int
+    # VehicleStopStatus name
+    status: str
+    # Meters travelled along the trip's shape
+    distance: float
+
+
+class VehicleProgress:
+    # A vehicle closer than this to a stop (along the shape) is stopped at it
+    STOPPED_AT_RADIUS_M = 30
+    # Farther than this from the shape the vehicle is off route and not snapped
+    MAX_OFFSET_M = 300
+
+    # device_id -> (trip_id, segment) of the last snap, to search locally next time
+    _last_segment: Dict[Any, Tuple[str, int]] = {}
+    # device_id -> (trip_id, latitude, longitude, progress) of the last call
+    _last_progress: Dict[Any, Tuple[str, float, float, Optional[Progress]]] = {}
+
+    @staticmethod
+    def locate(device_id, trip_id, latitude, longitude) -> Optional[Progress]:
+        # Both feeds ask for the same position, only snap it once
+        last = VehicleProgress._last_progress.get(device_id)
+        if last is not None and last[:3] == (trip_id, latitude, longitude):
+            return last[3]
+
+        progress = VehicleProgress._calculate(device_id, trip_id, latitude, longitude)
+        VehicleProgress._last_progress[device_id] = (trip_id, latitude, longitude, progress)
+
+        return progress
+
+    @staticmethod
+    def clear():
+        VehicleProgress._last_segment.clear()
+        VehicleProgress._last_progress.clear()
+
+    @staticmethod
+    def _calculate(device_id, trip_id, latitude, longitude) -> Optional[Progress]:
+        gtfs = gtfs_context.current()
+
+        shape_id = gtfs.trip_shape(trip_id)
+        stop_distances = gtfs.stop_distances(trip_id)
+
+        if shape_id is None or stop_distances is None or len(stop_distances) == 0:
+            return None
+
+        last = VehicleProgress._last_segment.get(device_id)
+        hint = last[1] if last is not None and last[0] == trip_id else None
+
+        snap = gtfs.shapes.snap(shape_id, latitude, longitude, hint)
+        if snap is None or snap.offset > VehicleProgress.MAX_OFFSET_M:
+            VehicleProgress._last_segment.pop(device_id, None)
+            return None
+
+        VehicleProgress._last_segment[device_id] = (trip_id, snap.segment)
+
+        radius = VehicleProgress.STOPPED_AT_RADIUS_M
+
+        # First stop not passed yet
+        stop_index = int(np.searchsorted(stop_distances, snap.distance - radius))
+
+        if stop_index >= len(stop_distances):
+            return Progress(len(stop_distances) - 1, "STOPPED_AT", snap.distance)
+
+        if stop_distances[stop_index] <= snap.distance + radius:
+            return Progress(stop_index, "STOPPED_AT", snap.distance)
+
+        return Progress(stop_index, "IN_TRANSIT_TO", snap.distance)
+
+# Segment indexes refer to the shapes they were snapped on
+gtfs_context.add_listener(VehicleProgress.clear)
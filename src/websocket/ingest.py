@@ -0,0 +1,141 @@
+import asyncio
+import orjson
+import logging
+
+from typing import Any, Dict, List, Optional, Union
+
+from src.context import context
+from src.state import parse_time
+from src.metrics import INGEST_COALESCED, registry
+from src.websocket.wal import WriteAheadLog
+
+logger = logging.getLogger(__name__)
+
+class IngestPipeline:
+    # Raw frames waiting to be applied, the receiver blocks once this is full
+    MAX_QUEUE = 1000
+    # Frames applied together, positions within a batch are coalesced
+    MAX_BATCH = 200
+
+    def __init__(self) -> None:
+        self._queue: "asyncio.Queue[Union[str, bytes, Dict[str, Any]]]" = asyncio.Queue(maxsize=self.MAX_QUEUE)
+
+        self.received = 0
+        self.batches = 0
+        self.invalid = 0
+        self.positions = 0
+        # Positions dropped because a newer one of the same device came in the same batch
+        self.coalesced = 0
+
+        # Set when the state is persisted, see WriteAheadLog
+        self.wal: Optional[WriteAheadLog] = None
+
+    async def put(self, frame: Union[str, bytes, Dict[str, Any]]) -> None:
+        # Waits while the queue is full, pushing the backpressure onto the socket
+        self.received += 1
+        await self._queue.put(frame)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self.MAX_QUEUE,
+            "received": self.received,
+            "batches": self.batches,
+            "invalid": self.invalid,
+            "positions": self.positions,
+            "coalesced": self.coalesced,
+            "wal": self.wal.stats() if self.wal is not None else None
+        }
+
+    async def run(self) -> None:
+        while True:
+            frames = [await self._queue.get()]
+
+            while len(frames) < self.MAX_BATCH and not self._queue.empty():
+                frames.append(self._queue.get_nowait())
+
+            try:
+                self._apply(frames)
+            except Exception as e:
+                logger.error(f"Failed to apply a batch of {len(frames)} Traccar messages: {e}")
+
+            # Let the HTTP handlers run between batches
+            await asyncio.sleep(0)
+
+    def _apply(self, frames: List[Union[str, bytes, Dict[str, Any]]]) -> None:
+        # Only the latest list of geofences matters, it's complete every time
+        geofences: Optional[List[Dict[str, Any]]] = None
+        devices: List[Dict[str, Any]] = []
+        events: List[Dict[str, Any]] = []
+        # device_id -> (fix time, position), only the latest fix of each device survives
+        positions: Dict[Any, Any] = {}
+
+        for frame in frames:
+            # Raw WebSocket frames, or messages already decoded like the REST bootstrap
+            if isinstance(frame, dict):
+                message: Dict[str, Any] = frame
+            else:
+                try:
+                    message = orjson.loads(frame)
+                except orjson.JSONDecodeError:
+                    self.invalid += 1
+                    continue
+
+            if "geofences" in message:
+                geofences = message["geofences"]
+
+            devices.extend(message.get("devices", []))
+            events.extend(message.get("events", []))
+
+            for position in message.get("positions", []):
+                self.positions += 1
+
+                device_id = position["deviceId"]
+                fix_time = parse_time(position.get("fixTime") or position.get("deviceTime"))
+                latest = positions.get(device_id)
+
+                if latest is not None:
+                    self.coalesced += 1
+                    INGEST_COALESCED.inc()
+                    if latest[0] is not None and fix_time is not None and latest[0] > fix_time:
+                        continue
+
+                positions[device_id] = (fix_time, position)
+
+        self.batches += 1
+
+        batch = {"geofences": geofences, "devices": devices, "events": events, "positions": [position for _, position in positions.values()]}
+        self._load(batch)
+
+        # Logged once applied, a batch that failed isn't replayed on the next start either
+        if self.wal is not None:
+            self.wal.append(batch)
+
+        logger.debug(f"Applied {len(frames)} Traccar messages, {len(positions)} positions")
+
+    def restore(self, messages: List[Dict[str, Any]]) -> None:
+        # State saved by the write-ahead log, applied as is before the ingest starts
+        for message in messages:
+            try:
+                self._load(message)
+            except Exception as e:
+                logger.error(f"Failed to restore a saved state record: {e}")
+
+    def _load(self, message: Dict[str, Any]) -> None:
+        # Geofences first, then devices, so positions of newly mapped devices aren't dropped
+        if message.get("geofences") is not None:
+            context.load_data({"geofences": message["geofences"]})
+        if message.get("devices"):
+            context.load_data({"devices": message["devices"]})
+        if message.get("events"):
+            context.load_data({"events": message["events"]})
+        if message.get("positions"):
+            context.load_data({"positions": message["positions"]})
+
+
+ingest: IngestPipeline = IngestPipeline()
+
+registry.gauge("gtfsrt_ingest_queue_depth", "Traccar frames waiting to be applied", collect=ingest.depth)
@@ -0,0 +1,53 @@
+import gzip
+import atexit
+import orjson
+import logging
+
+from time import time, monotonic
+from pathlib import Path
+from typing import Any, Dict, Iterator, Union
+
+logger = logging.getLogger(__name__)
+
+class TrafficRecorder:
+    # Seconds between flushes, a crash loses at most this much traffic
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Appending adds a gzip member per run, readers see a single stream
+        self._file = gzip.open(self._path, "ab", compresslevel=6)
+        self._last_flush = monotonic()
+        self.frames = 0
+        # The client runs until the process stops, the gzip trailer is written then
+        atexit.register(self.close)
+
+        logger.info(f"Recording Traccar traffic to {self._path}")
+
+    def record(self, source: str, data: Union[str, bytes]) -> None:
+        # source is "socket" for WebSocket frames, or the REST path of a response
+        if isinstance(data, bytes):
+            data = data.decode()
+
+        self._file.write(orjson.dumps({"time": time(), "source": source, "data": data}) + b"\n")
+        self.frames += 1
+
+        if monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+            self._file.flush()
+            self._last_flush = monotonic()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_recording(path: Union[str, Path]) -> Iterator[Dict[str, Any]]:
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                yield orjson.loads(line)
+        except EOFError:
+            # The recorder was killed before closing the file, keep what was flushed
+            logger.warning(f"Recording {path} is truncated")
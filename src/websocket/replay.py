@@ -0,0 +1,127 @@
+import uuid
+import asyncio
+import logging
+import argparse
+import uvicorn
+
+from time import monotonic
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Form, Request, Response, WebSocket, WebSocketDisconnect
+
+from .recorder import read_recording
+
+logger = logging.getLogger(__name__)
+
+# Fake Traccar server replaying a recording of TrafficRecorder, so ingest and the
+# feeds can be load tested without a live server. Point url at it, for example
+#   python -m src.websocket.replay traffic.jsonl.gz --speed 10 --port 8082
+#   url=http://127.0.0.1:8082/api
+
+def load_recording(path: Path) -> Tuple[List[Tuple[float, str]], Dict[str, str]]:
+    frames: List[Tuple[float, str]] = []
+    # REST path -> first recorded body, the state when the recording started
+    responses: Dict[str, str] = {}
+
+    for line in read_recording(path):
+        if line["source"] == "socket":
+            frames.append((line["time"], line["data"]))
+        else:
+            responses.setdefault(line["source"], line["data"])
+
+    return frames, responses
+
+
+def create_app(path: Path, speed: Optional[float] = 1.0, loop: bool = False) -> FastAPI:
+    # speed None replays as fast as the client reads
+    frames, responses = load_recording(path)
+    sessions = set()
+
+    logger.info(f"Loaded {len(frames)} frames and {len(responses)} REST responses from {path}")
+
+    app = FastAPI(title="Traccar replay")
+
+    @app.post("/api/session")
+    async def login(email: str = Form(...), password: str = Form(...)):
+        session_id = uuid.uuid4().hex
+        sessions.add(session_id)
+
+        response = Response(content="{}", media_type="application/json")
+        response.headers["Set-Cookie"] = f"JSESSIONID={session_id}; Path=/api; HttpOnly"
+
+        return response
+
+    @app.get("/api/{resource}")
+    async def rest(resource: str, request: Request):
+        if request.cookies.get("JSESSIONID") not in sessions:
+            return Response(status_code=401)
+
+        if resource not in ("devices", "positions", "geofences"):
+            return Response(status_code=404)
+
+        return Response(content=responses.get(f"/{resource}", "[]"), media_type="application/json")
+
+    @app.websocket("/api/socket")
+    async def socket(websocket: WebSocket):
+        if websocket.cookies.get("JSESSIONID") not in sessions:
+            await websocket.close(code=1008)
+            return
+
+        await websocket.accept()
+
+        try:
+            while True:
+                await replay(websocket)
+
+                if not loop:
+                    # Like a quiet Traccar, the connection stays open
+                    await websocket.receive()
+                    break
+        except WebSocketDisconnect:
+            pass
+
+    async def replay(websocket: WebSocket) -> None:
+        if not frames:
+            return
+
+        first_time = frames[0][0]
+        start = monotonic()
+
+        for frame_time, data in frames:
+            if speed is not None:
+                delay = (frame_time - first_time) / speed - (monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await websocket.send_text(data)
+
+        elapsed = monotonic() - start
+        logger.info(f"Replayed {len(frames)} frames in {elapsed:.2f}s, {len(frames) / max(elapsed, 1e-9):.0f} frames/s")
+
+    return app
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == "max":
+        return None
+
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or max")
+
+    return speed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded Traccar traffic as a fake Traccar server")
+    parser.add_argument("recording", type=Path, help="gzip JSONL file written by record_path")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1 for real time, N for N times faster or max")
+    parser.add_argument("--loop", action="store_true", help="start over when the recording ends")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+
+    uvicorn.run(create_app(args.recording, args.speed, args.loop), host=args.host, port=args.port)
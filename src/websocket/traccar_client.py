@@ -1,57 +1,175 @@
-import os
+import time
+import httpx
+import random
+import asyncio
 import orjson
 import logging
-import requests
 
 from .config import config
-from src.context import context
+from .ingest import ingest
+from .recorder import TrafficRecorder
+from src.metrics import TRACCAR_CONNECTED, TRACCAR_LAST_MESSAGE, TRACCAR_RECONNECTS
 
-from typing import Dict, Any
+from typing import Iterator, Optional
 from websockets.asyncio.client import connect
-from websockets.exceptions import ConnectionClosed
+from websockets.exceptions import ConnectionClosed, InvalidHandshake, InvalidStatus
 
 logger = logging.getLogger(__name__)
 
+class TraccarAuthError(Exception):
+    pass
+
+
+def backoff_delays(base: float = 1.0, cap: float = 60.0) -> Iterator[float]:
+    # Exponential backoff with full jitter, so instances don't reconnect in lockstep
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+
 class TraccarSession:
     def __init__(self) -> None:
         self._url = config["url"]
         self._email = config["email"]
         self._password = config["password"]
-        self._cookie: str = self._login().split(';')[0]
+        self._cookie: Optional[str] = None
+        self._login_lock = asyncio.Lock()
 
-    def _login(self) -> str:
-        response = requests.post(
-            f"{self._url}/session?email={self._email}&password={self._password}",
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"
-            }
+        # One pooled client for every REST call to Traccar
+        self._client = httpx.AsyncClient(
+            base_url=self._url,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5)
         )
 
-        if response.status_code != 200 and "Set-Cookie" not in response.headers:
-            logger.error("Attempt to log in failed. Be sure that the provided credentials are correct.")
-            return None
+    async def _login(self, stale_cookie: Optional[str] = None) -> str:
+        async with self._login_lock:
+            # Someone else logged in again while we waited
+            if self._cookie is not None and self._cookie != stale_cookie:
+                return self._cookie
+
+            # Credentials go in the form body, never in the URL
+            response = await self._client.post(
+                "/session",
+                data={"email": self._email, "password": self._password}
+            )
+
+            set_cookie = response.headers.get("Set-Cookie")
+            if response.status_code != 200 or set_cookie is None:
+                logger.error("Attempt to log in failed. Be sure that the provided credentials are correct.")
+                raise TraccarAuthError(f"Login rejected with status {response.status_code}")
+
+            logger.info("Logging successful.")
+            self._cookie = set_cookie.split(';')[0]
+
+            return self._cookie
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        cookie = self._cookie or await self._login()
+        response = await self._client.request(method, path, headers={"Cookie": cookie}, **kwargs)
+
+        # The session expired, log in again once and retry
+        if response.status_code == 401:
+            cookie = await self._login(stale_cookie=cookie)
+            response = await self._client.request(method, path, headers={"Cookie": cookie}, **kwargs)
+
+        response.raise_for_status()
+
+        return response
+
+    async def close(self) -> None:
+        await self._client.aclose()
 
-        logger.info("Logging successful.")
-        return response.headers["Set-Cookie"]
 
 class WsTraccarClient(TraccarSession):
     def __init__(self) -> None:
         super().__init__()
         self._uri = f"{self._url.replace('http', 'ws')}/socket"
-        self._headers = {"Cookie": self._cookie}
 
-    async def get_messages(self) -> None:
+        # Raw traffic is kept for replay when record_path is set, see src.websocket.replay
+        record_path = config.get("record_path")
+        self._recorder = TrafficRecorder(record_path) if record_path else None
+
+    async def bootstrap(self) -> None:
+        # Devices and their last positions, so the feeds don't wait for every vehicle to report again.
+        # Geofences too, their route attribute maps them to routes and may have changed meanwhile.
         try:
-            async for websocket in connect(self._uri, additional_headers=self._headers):
-                try:
-                    while True:
-                        message: Dict[str, Any] = orjson.loads(await websocket.recv())
-
-                        logger.info("Message recived!")
-                        
-                        context.load_data(message)
-                except ConnectionClosed:
+            geofences, devices, positions = await asyncio.gather(
+                self.request("GET", "/geofences"),
+                self.request("GET", "/devices"),
+                self.request("GET", "/positions")
+            )
+
+            message = {
+                "geofences": orjson.loads(geofences.content),
+                "devices": orjson.loads(devices.content),
+                "positions": orjson.loads(positions.content)
+            }
+
+            # A proxy's error page or a cut off body isn't the lists Traccar sends
+            if not all(isinstance(items, list) for items in message.values()):
+                raise ValueError("Traccar didn't answer with lists")
+        except (TraccarAuthError, httpx.HTTPError, ValueError) as e:
+            # orjson.JSONDecodeError is a ValueError
+            logger.warning(f"Traccar bootstrap failed, waiting for the stream instead: {e}")
+            return
+
+        if self._recorder is not None:
+            self._recorder.record("/geofences", geofences.content)
+            self._recorder.record("/devices", devices.content)
+            self._recorder.record("/positions", positions.content)
+
+        logger.info(f"Bootstrapped {len(message['geofences'])} geofences, {len(message['devices'])} devices and {len(message['positions'])} positions from Traccar.")
+
+        await ingest.put(message)
+
+    async def get_messages(self) -> None:
+        delays = backoff_delays()
+
+        while True:
+            cookie = self._cookie
+
+            try:
+                cookie = cookie or await self._login()
+
+                async with connect(self._uri, additional_headers={"Cookie": cookie}) as websocket:
+                    logger.info("Connected to Traccar WebSocket.")
+                    TRACCAR_CONNECTED.set(1)
+                    delays = backoff_delays()
+
+                    # Queued ahead of the first frame, so the stream only updates the snapshot
+                    await self.bootstrap()
+
+                    # Frames are only queued here, decoding and applying them is up to the ingest pipeline
+                    async for frame in websocket:
+                        logger.debug("Message recived!")
+                        TRACCAR_LAST_MESSAGE.set(time.time())
+
+                        if self._recorder is not None:
+                            self._recorder.record("socket", frame)
+
+                        await ingest.put(frame)
+
                     logger.info("Connection to Traccar WebSocket closed. Attempting to reconnect...")
-                    continue
-        except Exception as e:
-            logger.critical(f"Conecction to web socket failed: {e}")
\ No newline at end of file
+            except InvalidStatus as e:
+                # The handshake was refused, most likely because the session expired
+                if e.response.status_code in (401, 403):
+                    logger.warning("Traccar WebSocket rejected the session, logging in again...")
+                    try:
+                        await self._login(stale_cookie=cookie)
+                    except (TraccarAuthError, httpx.HTTPError) as e:
+                        logger.error(f"Login to Traccar failed: {e}")
+                else:
+                    logger.error(f"Traccar WebSocket handshake failed: {e}")
+            except ConnectionClosed:
+                logger.info("Connection to Traccar WebSocket closed. Attempting to reconnect...")
+            except (InvalidHandshake, TraccarAuthError, httpx.HTTPError, orjson.JSONDecodeError, OSError) as e:
+                logger.error(f"Conecction to web socket failed: {e}")
+
+            TRACCAR_CONNECTED.set(0)
+            TRACCAR_RECONNECTS.inc()
+
+            delay = next(delays)
+            logger.info(f"Reconnecting to Traccar in {delay:.1f}s")
+            await asyncio.sleep(delay)
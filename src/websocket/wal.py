@@ -0,0 +1,306 @@
+import os
+import gzip
+import orjson
+import asyncio
+import logging
+
+from time import time, monotonic
+from pathlib import Path
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+from src.context import context
+from src.alerts import AlertStore, is_geofence_enter, is_geofence_exit
+from src.state import PositionHistory, VehicleEvent, parse_time
+
+logger = logging.getLogger(__name__)
+
+# Fields of the Traccar messages the live state is rebuilt from, the rest isn't logged
+POSITION_FIELDS = ("id", "deviceId", "latitude", "longitude", "course", "speed", "deviceTime", "fixTime")
+EVENT_FIELDS = ("id", "deviceId", "type", "eventTime", "geofenceId")
+
+def _slim_device(device: Dict[str, Any]) -> Dict[str, Any]:
+    slim = {"id": device["id"], "name": device.get("name")}
+
+    geofence_id = device.get("attributes", {}).get("currentGeofence")
+    if geofence_id is not None:
+        slim["attributes"] = {"currentGeofence": geofence_id}
+
+    return slim
+
+
+def _slim_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    slim = {field: event.get(field) for field in EVENT_FIELDS}
+
+    alarm = event.get("attributes", {}).get("alarm")
+    if alarm:
+        slim["attributes"] = {"alarm": alarm}
+
+    return slim
+
+
+class WriteAheadLog:
+    # Seconds between group commits, a crash loses at most this much state
+    FLUSH_INTERVAL = float(os.getenv("wal_flush_interval") or 1.0)
+    # The log is folded into a new snapshot this often, or once it grows past COMPACT_BYTES
+    COMPACT_INTERVAL = float(os.getenv("wal_compact_interval") or 300)
+    COMPACT_BYTES = 64 * 1024 * 1024
+    # Enough positions to refill the vehicles' history, alerts need their geofence events
+    POSITIONS_KEPT = PositionHistory.SIZE
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, directory: Union[str, Path]) -> None:
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._snapshot_path = self._directory / "state.snapshot"
+
+        # Lines appended since the last group commit
+        self._pending: List[bytes] = []
+        # Logs are numbered, the snapshot names the first one written after it
+        self._generation = 0
+        self._file = None
+        self._log_bytes = 0
+        self._last_compaction = monotonic()
+
+        # What the next snapshot holds, kept up to date as messages are appended
+        self._geofences: Optional[List[Dict[str, Any]]] = None
+        self._devices: Dict[Any, Dict[str, Any]] = {}
+        self._positions: Dict[Any, Deque[Dict[str, Any]]] = {}
+        # device_id -> geofence events, the alerts are rebuilt from them, and the last event
+        self._alert_events: Dict[Any, Deque[Dict[str, Any]]] = {}
+        self._last_events: Dict[Any, Dict[str, Any]] = {}
+
+        self.records = 0
+        self.commits = 0
+        self.compactions = 0
+        self.replayed = 0
+
+    def append(self, message: Dict[str, Any]) -> None:
+        # A batch as applied by the ingest pipeline, committed to disk by run()
+        slim: Dict[str, Any] = {}
+
+        if message.get("geofences") is not None:
+            slim["geofences"] = message["geofences"]
+        if message.get("devices"):
+            slim["devices"] = [_slim_device(device) for device in message["devices"]]
+        if message.get("events"):
+            slim["events"] = [_slim_event(event) for event in message["events"]]
+        if message.get("positions"):
+            slim["positions"] = [{field: position.get(field) for field in POSITION_FIELDS} for position in message["positions"]]
+
+        if not slim:
+            return
+
+        self._remember(slim)
+        self._pending.append(orjson.dumps(slim) + b"\n")
+        self.records += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "records": self.records,
+            "commits": self.commits,
+            "compactions": self.compactions,
+            "replayed": self.replayed,
+            "log_bytes": self._log_bytes,
+            "generation": self._generation
+        }
+
+    def load(self) -> List[Dict[str, Any]]:
+        # Messages of the snapshot and the log tail after it, oldest first. Runs before the
+        # ingest starts and off the event loop, the caller applies them
+        messages: List[Dict[str, Any]] = []
+        generation = 0
+
+        if self._snapshot_path.exists():
+            try:
+                with gzip.open(self._snapshot_path, "rb") as f:
+                    snapshot = orjson.loads(f.read())
+
+                if snapshot.get("version") == self.SNAPSHOT_VERSION:
+                    generation = snapshot["generation"]
+                    messages.append(snapshot["state"])
+                else:
+                    logger.warning(f"Ignoring snapshot {self._snapshot_path} of version {snapshot.get('version')}")
+            except (OSError, EOFError, orjson.JSONDecodeError, KeyError) as e:
+                logger.error(f"Failed to read snapshot {self._snapshot_path}: {e}")
+
+        for log_generation, path in self._logs():
+            # Already folded into the snapshot, left by a crash during compaction
+            if log_generation < generation:
+                continue
+
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        messages.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        # The last group commit was cut short, keep what came before it
+                        logger.warning(f"Write-ahead log {path.name} is truncated")
+                        break
+
+        for message in messages:
+            self._remember(message)
+
+        self._generation = max([generation, *(log_generation for log_generation, _ in self._logs())]) + 1
+        self.replayed = len(messages)
+
+        logger.info(f"Loaded {len(messages)} state records from {self._directory}")
+
+        return messages
+
+    async def run(self) -> None:
+        # The replayed state goes into a first snapshot, later logs start from it
+        await self.compact()
+
+        try:
+            while True:
+                await asyncio.sleep(self.FLUSH_INTERVAL)
+
+                try:
+                    if self._log_bytes >= self.COMPACT_BYTES or monotonic() - self._last_compaction >= self.COMPACT_INTERVAL:
+                        await self.compact()
+                    else:
+                        await self.commit()
+                except OSError as e:
+                    logger.error(f"Failed to persist state to {self._directory}: {e}")
+        finally:
+            self.close()
+
+    async def commit(self) -> None:
+        # Group commit, one write and fsync for every message appended meanwhile
+        if not self._pending:
+            return
+
+        data = b"".join(self._pending)
+        self._pending = []
+
+        await asyncio.to_thread(self._write, data)
+        self.commits += 1
+
+    async def compact(self) -> None:
+        # Taken together on the event loop, so the pending lines are exactly what the log misses
+        state = self._state()
+        pending = self._pending
+        self._pending = []
+
+        generation = self._generation
+        self._generation += 1
+
+        try:
+            await asyncio.to_thread(self._write_snapshot, state, generation + 1)
+        except OSError:
+            # The old log stays the source of truth, with the lines it was missing
+            self._generation = generation
+            if pending:
+                await asyncio.to_thread(self._write, b"".join(pending))
+            raise
+
+        self._last_compaction = monotonic()
+        self.compactions += 1
+
+        logger.debug(f"Compacted the state to {self._snapshot_path}, {len(self._devices)} devices")
+
+    def close(self) -> None:
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def _logs(self) -> List[Tuple[int, Path]]:
+        logs = []
+        for path in self._directory.glob("state.*.wal"):
+            try:
+                logs.append((int(path.name.split(".")[1]), path))
+            except ValueError:
+                continue
+
+        return sorted(logs)
+
+    def _log_path(self, generation: int) -> Path:
+        return self._directory / f"state.{generation}.wal"
+
+    def _write(self, data: bytes) -> None:
+        if self._file is None or self._file.closed:
+            self._file = open(self._log_path(self._generation), "ab")
+
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._log_bytes += len(data)
+
+    def _write_snapshot(self, state: bytes, generation: int) -> None:
+        tmp_path = self._snapshot_path.with_suffix(".tmp")
+
+        with open(tmp_path, "wb") as f:
+            f.write(gzip.compress(state, compresslevel=1))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # The new log only counts once the snapshot naming it is in place
+        os.replace(tmp_path, self._snapshot_path)
+
+        self.close()
+        self._file = None
+        self._log_bytes = 0
+
+        for log_generation, path in self._logs():
+            if log_generation < generation:
+                path.unlink(missing_ok=True)
+
+        directory = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _remember(self, message: Dict[str, Any]) -> None:
+        if message.get("geofences") is not None:
+            self._geofences = message["geofences"]
+
+        for device in message.get("devices", []):
+            self._devices[device["id"]] = device
+
+        for event in message.get("events", []):
+            device_id = event["deviceId"]
+            self._last_events[device_id] = event
+
+            parsed = VehicleEvent(event)
+            if is_geofence_exit(parsed) or is_geofence_enter(parsed):
+                self._alert_events.setdefault(device_id, deque()).append(event)
+
+        for position in message.get("positions", []):
+            positions = self._positions.get(position["deviceId"])
+            if positions is None:
+                positions = self._positions[position["deviceId"]] = deque(maxlen=self.POSITIONS_KEPT)
+
+            positions.append(position)
+
+    def _state(self) -> bytes:
+        # The whole state as a single message, in the order the ingest applies them
+        now = time()
+        events = []
+        # Geofence events older than this can't open or close a published alert anymore
+        max_age = context.alerts.ttl + AlertStore.CLOSED_RETENTION
+
+        for device_id, last_event in self._last_events.items():
+            alert_events = self._alert_events.get(device_id)
+
+            if alert_events:
+                while alert_events and now - (parse_time(alert_events[0].get("eventTime")) or now) > max_age:
+                    alert_events.popleft()
+
+                events.extend(event for event in alert_events if event is not last_event)
+
+            # Last, so it's the vehicle's event again
+            events.append(last_event)
+
+        state: Dict[str, Any] = {
+            "devices": list(self._devices.values()),
+            "events": events,
+            "positions": [position for positions in self._positions.values() for position in positions]
+        }
+        if self._geofences is not None:
+            state["geofences"] = self._geofences
+
+        return orjson.dumps({"version": self.SNAPSHOT_VERSION, "generation": self._generation + 1, "time": now, "state": state})
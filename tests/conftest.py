@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# The modules read the timezone when imported, tests don't need a .env
+os.environ.setdefault("timezone", "America/Guayaquil")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
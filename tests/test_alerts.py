@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src.context import context
+
+START = datetime.now(timezone.utc).replace(microsecond=0)
+# Not a route geofence, like a depot
+DEPOT = 999
+
+def _time(seconds: int) -> str:
+    return (START + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S.000+00:00")
+
+
+def _event(event_id: int, event_type: str, geofence_id: int, second: int):
+    return {"events": [{"id": event_id, "deviceId": 1, "type": event_type, "eventTime": _time(second), "geofenceId": geofence_id, "attributes": {}}]}
+
+
+def _alerts():
+    return sorted((alert.id, alert.route_id, alert.is_open) for alert in context.alerts.alerts())
+
+
+@pytest.fixture(autouse=True)
+def _bus():
+    # Geofence 1 is route 55 by default
+    context.data.clear()
+    context.alerts.clear()
+    assert DEPOT not in context.routes_ids
+
+    context.load_data({"devices": [{"id": 1, "name": "BUS1", "attributes": {"currentGeofence": 1}}]})
+    yield
+    context.data.clear()
+    context.alerts.clear()
+
+
+def test_exiting_a_geofence_that_is_no_route_opens_no_alert():
+    context.load_data(_event(10, "geofenceExited", DEPOT, 1))
+
+    assert _alerts() == []
+    assert context.data[1].event.id == 10
+
+
+def test_entering_a_geofence_that_is_no_route_keeps_the_detour_open():
+    context.load_data(_event(10, "geofenceExited", 1, 1))
+    context.load_data(_event(11, "geofenceEntered", DEPOT, 2))
+
+    assert _alerts() == [("D10", "55", True)]
+
+    context.load_data(_event(12, "geofenceEntered", 1, 3))
+
+    assert _alerts() == [("D10", "55", False)]
+
+
+def test_events_without_a_geofence_fall_back_to_the_vehicle_route():
+    context.load_data(_event(10, "geofenceExited", 0, 1))
+
+    assert _alerts() == [("D10", "55", True)]
+
+    context.load_data(_event(11, "geofenceEntered", 0, 2))
+
+    assert _alerts() == [("D10", "55", False)]
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from src.gtfs.schedule import Schedule
+
+
+def _schedule(arrivals):
+    trips = pd.DataFrame({"trip_id": ["A", "B"], "route_id": [1, 1], "service_id": ["WK", "WK"], "shape_id": ["S", "S"]})
+    stops = pd.DataFrame({"stop_id": ["s1", "s2", "s3"], "stop_lat": [-2.1, -2.2, -2.3], "stop_lon": [-79.1, -79.2, -79.3]})
+    stop_times = pd.DataFrame({
+        "trip_id": ["A", "A", "A", "B", "B", "B"],
+        "stop_id": ["s1", "s2", "s3", "s3", "s2", "s1"],
+        "stop_sequence": [1, 2, 3, 1, 2, 3],
+        "arrival_time": arrivals,
+        "departure_time": arrivals
+    })
+
+    return Schedule.build(trips, stops, stop_times)
+
+
+def test_missing_times_are_filled_within_their_trip():
+    schedule = _schedule(["08:00:00", None, "08:20:00", None, "09:10:00", "25:30:00"])
+
+    # B's first stop takes its next stop's time, not the last one of A
+    assert schedule.st_arrival.tolist() == [28800, 28800, 30000, 33000, 33000, 91800]
+    assert schedule.nearest_departure(1, ["WK"], 33000) == (0, "B")
+
+
+def test_stop_coordinates_are_read_through_the_stop_index():
+    schedule = _schedule(["08:00:00", "08:10:00", "08:20:00", "09:00:00", "09:10:00", "09:20:00"])
+
+    arrays = schedule.trip_arrays("B")
+    assert np.array_equal(arrays.stop_lat, [-2.3, -2.2, -2.1])
+    assert np.array_equal(arrays.stop_lon, [-79.3, -79.2, -79.1])
+    assert schedule.trip_stops("A")[1]["stop_id"] == "s2"
+    assert schedule.trip_stops("A")[1]["stop_lat"] == -2.2
@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+import multiprocessing
+
+from google.transit import gtfs_realtime_pb2 as gtfsrt
+
+from src.api import shared
+from src.api.shared import HEADER, RECORD, SharedFeedReader, SharedFeedWriter
+from src.api.snapshot import FeedSnapshot
+
+def _snapshot(version: int) -> FeedSnapshot:
+    # Feeds of different sizes, so a torn copy mixes lengths and contents
+    feed = gtfsrt.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = version
+
+    for i in range(50 + version % 7 * 40):
+        entity = feed.entity.add()
+        entity.id = f"{version}-{i}"
+        entity.vehicle.vehicle.id = f"BUS{version}-{i}"
+        entity.vehicle.position.latitude = version + i
+        entity.vehicle.position.longitude = -version - i
+
+    return FeedSnapshot(feed)
+
+
+def _publish(path, started, stop) -> None:
+    writer = SharedFeedWriter(path)
+    snapshots = [_snapshot(version) for version in range(1, 15)]
+
+    writer.publish(snapshots[0])
+    started.set()
+
+    sequence = 0
+    while not stop.is_set():
+        writer.publish(snapshots[sequence % len(snapshots)])
+        sequence += 1
+
+    writer.close()
+
+
+def test_reader_never_returns_a_torn_copy(tmp_path):
+    path = tmp_path / "trip_updates.feed"
+
+    # A separate process, the writer really runs while the reader copies
+    started = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    writer = multiprocessing.Process(target=_publish, args=(path, started, stop))
+    writer.start()
+
+    try:
+        assert started.wait(10)
+
+        reader = SharedFeedReader(path)
+        sequences = set()
+
+        for _ in range(20000):
+            snapshot = reader.current()
+            # Gave up on a slot that kept being overwritten before any read succeeded
+            if snapshot is None:
+                continue
+
+            assert hashlib.blake2b(snapshot.content, digest_size=16).hexdigest() == snapshot.digest
+            assert gzip.decompress(snapshot.gzip_content) == snapshot.content
+
+            sequences.add(reader.sequence)
+
+        # The reads raced the writer, not a single stale copy
+        assert len(sequences) > 1
+    finally:
+        stop.set()
+        writer.join(10)
+
+
+class _RecordHook:
+    # Runs a callback once, between the reader's unpacking of a slot and its copy of the content
+    def __init__(self, callback) -> None:
+        self._callback = callback
+
+    def unpack_from(self, buffer, offset=0):
+        values = RECORD.unpack_from(buffer, offset)
+
+        if self._callback is not None:
+            callback, self._callback = self._callback, None
+            callback()
+
+        return values
+
+    def __getattr__(self, name):
+        return getattr(RECORD, name)
+
+
+def test_reader_retries_a_slot_overwritten_while_copying(tmp_path, monkeypatch):
+    path = tmp_path / "service_alerts.feed"
+    writer = SharedFeedWriter(path)
+    reader = SharedFeedReader(path)
+
+    first, second = _snapshot(1), _snapshot(2)
+    writer.publish(first)
+
+    def overtake():
+        # The writer publishes the next sequence and starts on the one after it, in the slot being
+        # copied, while the header still announces the previous one
+        writer.publish(second)
+
+        offset = HEADER.size + (writer._sequence + 1) % 2 * writer._capacity + RECORD.size
+        writer._map[offset:offset + len(first.content)] = bytes(len(first.content))
+
+    monkeypatch.setattr(shared, "RECORD", _RecordHook(overtake))
+
+    snapshot = reader.current()
+
+    assert snapshot.content == second.content
+    assert reader.sequence == 2
+
+    writer.close()
+
+
+def test_reader_follows_the_published_sequence(tmp_path):
+    path = tmp_path / "vehicle_positions.feed"
+    writer = SharedFeedWriter(path)
+    reader = SharedFeedReader(path)
+
+    assert reader.current() is None
+
+    first = _snapshot(1)
+    writer.publish(first)
+    assert reader.current().digest == first.digest
+
+    # Unchanged sequence, the same object without copying again
+    assert reader.current() is reader.current()
+
+    second = _snapshot(2)
+    writer.publish(second)
+    assert reader.current().content == second.content
+
+    writer.close()
@@ -0,0 +1,32 @@
+import numpy as np
+from geopy.distance import geodesic
+
+from src.factories.trip_update import TripUpdate
+
+def _pairs(count: int, max_km: float):
+    # Points around the service area and neighbours up to max_km away, in every direction
+    rng = np.random.default_rng(7)
+
+    latitude = rng.uniform(-2.4, -1.9, count)
+    longitude = rng.uniform(-80.1, -79.7, count)
+    bearing = rng.uniform(0, 2 * np.pi, count)
+    distance = rng.uniform(0.05, max_km, count)
+
+    stop_lat = latitude + distance / 111.2 * np.cos(bearing)
+    stop_lon = longitude + distance / 111.2 * np.sin(bearing) / np.cos(np.radians(latitude))
+
+    return latitude, longitude, stop_lat, stop_lon
+
+
+def test_haversine_stays_close_to_geodesic_at_stop_spacing():
+    latitude, longitude, stop_lat, stop_lon = _pairs(1000, 3.0)
+
+    haversine = TripUpdate.haversine_km(latitude, longitude, stop_lat, stop_lon)
+    geodesic_km = np.array([geodesic(a, b).km for a, b in zip(zip(latitude, longitude), zip(stop_lat, stop_lon))])
+
+    error = np.abs(haversine - geodesic_km)
+
+    # The sphere is up to ~0.56% off the ellipsoid near the equator, a few seconds of ETA at bus speeds
+    assert (error / geodesic_km).max() < 0.006
+    assert error.max() * 1000 < 20
+
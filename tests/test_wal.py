@@ -0,0 +1,166 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+from src.context import context
+from src.websocket.ingest import ingest
+from src.websocket.wal import WriteAheadLog
+
+START = datetime.now(timezone.utc).replace(microsecond=0)
+
+def _time(seconds: int) -> str:
+    return (START + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S.000+00:00")
+
+
+def _devices():
+    # Geofences 1 and 2 are routes 55 and 50 by default
+    return {"devices": [{"id": i, "name": f"BUS{i}", "attributes": {"currentGeofence": 1 + i % 2}} for i in (1, 2, 3)]}
+
+
+def _positions(second: int):
+    return {"positions": [
+        {"id": i * 1000 + second, "deviceId": i, "latitude": -2.1 + second * 1e-4, "longitude": -79.9, "course": 0,
+         "speed": 5, "deviceTime": _time(second), "fixTime": _time(second), "attributes": {"ignition": True}}
+        for i in (1, 2, 3)
+    ]}
+
+
+def _event(event_id: int, device_id: int, event_type: str, second: int):
+    return {"events": [{"id": event_id, "deviceId": device_id, "type": event_type, "eventTime": _time(second), "geofenceId": 0, "attributes": {}}]}
+
+
+def _state():
+    vehicles = {
+        device_id: (state.name, state.route_id, state.position_id, state.fix_time, len(state.history), state.event.id if state.event else None)
+        for device_id, state in context.data.items()
+    }
+    alerts = sorted((alert.id, alert.device_id, alert.is_open) for alert in context.alerts.alerts())
+
+    return vehicles, alerts
+
+
+def _restore(directory: Path):
+    # A fresh start: empty state, then whatever the log brings back
+    context.data.clear()
+    context.alerts.clear()
+
+    wal = WriteAheadLog(directory)
+    ingest.restore(wal.load())
+
+    return wal
+
+
+class _Crash(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def _clean_state():
+    context.data.clear()
+    context.alerts.clear()
+    yield
+    context.data.clear()
+    context.alerts.clear()
+
+
+def test_crash_between_snapshot_and_log_deletion(tmp_path, monkeypatch):
+    wal = WriteAheadLog(tmp_path)
+    ingest.restore(wal.load())
+
+    async def run():
+        for message in (_devices(), _positions(0), _event(10, 1, "geofenceExited", 1), _positions(1)):
+            ingest._load(message)
+            wal.append(message)
+        await wal.commit()
+
+        # Closes the alert, so replaying the exit again would open a new one
+        for message in (_event(11, 1, "geofenceEntered", 2), _event(12, 2, "geofenceExited", 2), _positions(2)):
+            ingest._load(message)
+            wal.append(message)
+
+        # The process dies after the new snapshot is in place, before the old log is deleted
+        def crash(self, missing_ok=False):
+            raise _Crash()
+
+        with monkeypatch.context() as patch:
+            patch.setattr(Path, "unlink", crash)
+            with pytest.raises(_Crash):
+                await wal.compact()
+
+    asyncio.run(run())
+    expected = _state()
+
+    # The old log is left behind, the snapshot names the one after it
+    assert len(list(tmp_path.glob("state.*.wal"))) == 1
+    assert (tmp_path / "state.snapshot").exists()
+
+    restored = _restore(tmp_path)
+    assert _state() == expected
+    assert expected[1] == [("D10", 1, False), ("D12", 2, True)]
+
+    # The next compaction removes the log folded into the snapshot
+    asyncio.run(restored.compact())
+    assert list(tmp_path.glob("state.*.wal")) == []
+
+    _restore(tmp_path)
+    assert _state() == expected
+
+
+def test_log_appended_after_compaction_is_replayed(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    ingest.restore(wal.load())
+
+    async def run():
+        for message in (_devices(), _positions(0)):
+            ingest._load(message)
+            wal.append(message)
+        await wal.compact()
+
+        for message in (_positions(1), _event(20, 3, "geofenceExited", 1)):
+            ingest._load(message)
+            wal.append(message)
+        await wal.commit()
+
+    asyncio.run(run())
+    expected = _state()
+
+    _restore(tmp_path)
+    assert _state() == expected
+    assert context.data[3].position_id == 3001
+    assert len(context.data[3].history) == 2
+
+
+def test_truncated_last_line_keeps_the_records_before_it(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    ingest.restore(wal.load())
+
+    async def run():
+        for message in (_devices(), _positions(0), _positions(1)):
+            wal.append(message)
+        await wal.commit()
+
+        wal.append(_positions(2))
+        await wal.commit()
+
+    asyncio.run(run())
+    wal.close()
+
+    # The last group commit was cut short halfway through its line
+    (log,) = tmp_path.glob("state.*.wal")
+    data = log.read_bytes()
+    last_line = data.rstrip(b"\n").rsplit(b"\n", 1)[1]
+    log.write_bytes(data[:-len(last_line) // 2])
+
+    restored = _restore(tmp_path)
+
+    assert restored.replayed == 3
+    assert sorted(context.data) == [1, 2, 3]
+    assert {state.position_id for state in context.data.values()} == {1001, 2001, 3001}
+    assert all(len(state.history) == 2 for state in context.data.values())
+
+    # The torn record isn't in the next snapshot either
+    asyncio.run(restored.compact())
+    _restore(tmp_path)
+    assert {state.position_id for state in context.data.values()} == {1001, 2001, 3001}